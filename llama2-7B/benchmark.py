@@ -0,0 +1,574 @@
+"""CPU-runnable benchmarks for the optimizers in optim.py.
+
+Every benchmark builds matrices with the Llama-2-7B weight shapes (optionally
+scaled down with --scale), feeds them synthetic low-rank-plus-noise
+gradients and prints one row per configuration. --json switches the output
+to one JSON object per line.
+
+    python benchmark.py second_moment --scale 0.25 --steps 5
+    python benchmark.py range_finder --scale 1 --oversample 0 4 8 --n-iter 0 1 2
+    python benchmark.py nmf --shapes q_proj down_proj --rank 8 --steps 10
+    python benchmark.py galore_refresh --layers 4 --galore-T 8 --steps 16
+    python benchmark.py galore_memory --scale 1 --rank 128 --dtype bfloat16
+    python benchmark.py quantized_factors --shapes embed_tokens lm_head --dtype bfloat16
+    python benchmark.py factor_update --shapes q_proj down_proj --steps 50
+    python benchmark.py kernels --shapes q_proj gate_proj --steps 20
+    python benchmark.py suite --ranks 4 16 --dtypes float32 bfloat16 --json > suite.jsonl
+    python benchmark.py workers --workers 1 4 16 --layers 4
+    python benchmark.py sketch --sketch-refresh 1 8 --shapes q_proj --layers 4
+"""
+import argparse
+import functools
+import json
+import math
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+import optim
+
+try:
+    from lion_pytorch import Lion
+except ImportError:  # only needed for the Lion baseline of the suite benchmark
+    Lion = None
+
+# nn.Linear weights are (out_features, in_features)
+LLAMA2_7B_SHAPES = {
+    "q_proj": (4096, 4096),
+    "k_proj": (4096, 4096),
+    "v_proj": (4096, 4096),
+    "o_proj": (4096, 4096),
+    "gate_proj": (11008, 4096),
+    "up_proj": (11008, 4096),
+    "down_proj": (4096, 11008),
+    "embed_tokens": (32000, 4096),
+    "lm_head": (32000, 4096),
+}
+LLAMA2_7B_LAYERS = 32
+
+
+def llama_shapes(scale=1.0, names=None):
+    """Llama-2-7B matrix shapes, each side multiplied by ``scale``."""
+    names = names or list(LLAMA2_7B_SHAPES)
+    return {name: tuple(max(1, int(d * scale)) for d in LLAMA2_7B_SHAPES[name]) for name in names}
+
+
+def llama2_7b_parameters(scale=1.0):
+    """(name, shape) of every Llama-2-7B weight matrix: 32 decoder layers plus the embeddings."""
+    shapes = llama_shapes(scale)
+    for layer in range(LLAMA2_7B_LAYERS):
+        for name, shape in shapes.items():
+            if name not in ("embed_tokens", "lm_head"):
+                yield "layers.{}.{}".format(layer, name), shape
+    yield "embed_tokens", shapes["embed_tokens"]
+    yield "lm_head", shapes["lm_head"]
+
+
+def synthetic_grad(shape, dtype=torch.float32, rank=16, noise=0.1, generator=None):
+    """Gradient-like matrix: a rank-``rank`` signal plus Gaussian noise."""
+    m, n = shape
+    signal = torch.randn(m, rank, generator=generator) @ torch.randn(rank, n, generator=generator) / rank ** 0.5
+    return (signal + noise * torch.randn(m, n, generator=generator)).to(dtype)
+
+
+def relative_error(approx, exact):
+    return ((approx.float() - exact.float()).norm() / exact.float().norm().clamp_min(1e-30)).item()
+
+
+def state_bytes(state):
+    # nested dicts hold e.g. MLorc_AdamW's cached Grams
+    return sum(v.numel() * v.element_size() if torch.is_tensor(v) else state_bytes(v)
+               for v in state.values() if torch.is_tensor(v) or isinstance(v, dict))
+
+
+def timed(fn, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return time.perf_counter() - start
+
+
+def report(rows, as_json):
+    if as_json:
+        for row in rows:
+            print(json.dumps(row))
+        return
+    keys = list(rows[0])
+    widths = [max(len(k), *(len(_fmt(r[k])) for r in rows)) for k in keys]
+    print("  ".join(k.ljust(w) for k, w in zip(keys, widths)))
+    for row in rows:
+        print("  ".join(_fmt(row[k]).ljust(w) for k, w in zip(keys, widths)))
+
+
+def _fmt(value):
+    return "{:.4g}".format(value) if isinstance(value, float) else str(value)
+
+
+def second_moment_estimate(opt, p):
+    """Second moment the optimizer currently divides by, as a dense matrix."""
+    state = opt.state[p]
+    if "sq_row" in state:
+        return torch.outer(state["sq_row"], state["sq_col"]) / state["sq_row"].mean()
+    return optim.reconstruct(state["sq_u"], state["sq_s"], state["sq_v"]).abs()
+
+
+def bench_second_moment(args):
+    """MLorc_AdamW2 with rank-r SVD or NMF sq_u/sq_s/sq_v against factored row/column second moments."""
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    rows = []
+    for name, shape in llama_shapes(args.scale, args.shapes).items():
+        for mode in ("svd", "factored", "nmf"):
+            generator = torch.Generator().manual_seed(args.seed)
+            p = torch.nn.Parameter(torch.zeros(shape, dtype=dtype, device=device))
+            opt = optim.MLorc_AdamW2([p], lr=1e-5, weight_decay=0.0, rank=args.rank, second_moment=mode)
+            beta2 = opt.param_groups[0]["betas"][1]
+            exact = torch.zeros(shape, device=device)
+            seconds = 0.0
+            for step in range(args.steps):
+                grad = synthetic_grad(shape, dtype, generator=generator).to(device)
+                exact.mul_(beta2).addcmul_(grad.float(), grad.float(), value=1 - beta2)
+                p.grad = grad
+                elapsed = timed(opt.step, device)
+                if step > 0:  # the first step pays for state and workspace allocation
+                    seconds += elapsed
+            rows.append(dict(shape=name, m=shape[0], n=shape[1], second_moment=mode, rank=args.rank,
+                             ms_per_step=1e3 * seconds / max(1, args.steps - 1),
+                             state_bytes=state_bytes(opt.state[p]),
+                             sq_rel_error=relative_error(second_moment_estimate(opt, p), exact)))
+    report(rows, args.json)
+
+
+def first_moment_estimate(opt, p):
+    """First moment the optimizer currently stores, as a dense matrix."""
+    state = opt.state[p]
+    if "projector" in state:
+        m = state["projector"] @ state["exp_avg"]
+        return m.mT if optim.projects_right(p.shape, opt.proj_side) else m
+    if "exp_avg" in state:  # torch AdamW, lion_pytorch
+        return state["exp_avg"]
+    if "m_A" in state:
+        return state["m_A"] @ state["m_B"]
+    if "m_u_q" in state:
+        u, v = (optim.dequantize_blockwise(state[k + "_q"], state[k + "_absmax"], opt.quant_block_size)
+                for k in ("m_u", "m_v"))
+        return optim.reconstruct(u, state["m_s"].float(), v)
+    return optim.reconstruct(state["m_u"], state["m_s"], state["m_v"])
+
+
+def bench_quantized_factors(args):
+    """MLorc_AdamW2 state bytes and first-moment error with dense against blockwise int8 u/v factors."""
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    rows = []
+    for name, shape in llama_shapes(args.scale, args.shapes).items():
+        for quantize in (False, True):
+            generator = torch.Generator().manual_seed(args.seed)
+            p = torch.nn.Parameter(torch.zeros(shape, dtype=dtype, device=device))
+            opt = optim.MLorc_AdamW2([p], lr=1e-5, weight_decay=0.0, rank=args.rank, quantize_factors=quantize)
+            beta1 = opt.param_groups[0]["betas"][0]
+            exact = torch.zeros(shape, device=device)
+            seconds = 0.0
+            for step in range(args.steps):
+                grad = synthetic_grad(shape, dtype, generator=generator).to(device)
+                exact.mul_(beta1).add_(grad.float(), alpha=1 - beta1)
+                p.grad = grad
+                elapsed = timed(opt.step, device)
+                if step > 0:
+                    seconds += elapsed
+            rows.append(dict(shape=name, m=shape[0], n=shape[1], quantize_factors=quantize, rank=args.rank,
+                             ms_per_step=1e3 * seconds / max(1, args.steps - 1),
+                             state_bytes=state_bytes(opt.state[p]),
+                             m_rel_error=relative_error(first_moment_estimate(opt, p), exact)))
+    report(rows, args.json)
+
+
+def truncation_error(exact, rank):
+    """Relative error of the best rank-``rank`` approximation of ``exact``, the floor for a rank-``rank`` state."""
+    U, S, Vh = torch.linalg.svd(exact.float(), full_matrices=False)
+    return relative_error((U[:, :rank] * S[:rank]) @ Vh[:rank], exact)
+
+
+def bench_factor_update(args):
+    """How closely MLorc_AdamW's factor_update moments track the exact moments under drifting gradients.
+
+    The gradients are a rank-r signal whose left and right factors take a
+    small random step every step, plus noise, so the subspace the moments live
+    in keeps moving. m_floor and sq_floor are the errors of the best rank-r
+    approximations of the exact moments.
+    """
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    rows = []
+    for name, shape in llama_shapes(args.scale, args.shapes).items():
+        generator = torch.Generator().manual_seed(args.seed)
+        left = torch.randn(shape[0], args.rank, generator=generator)
+        right = torch.randn(args.rank, shape[1], generator=generator)
+        p = torch.nn.Parameter(torch.zeros(shape, dtype=dtype, device=device))
+        opt = optim.MLorc_AdamW([p], lr=1e-5, weight_decay=0.0, rank=args.rank, factor_update=True)
+        beta1, beta2 = opt.param_groups[0]["betas"]
+        m, sq = torch.zeros(shape, device=device), torch.zeros(shape, device=device)
+        seconds = 0.0
+        for step in range(args.steps):
+            left.add_(torch.randn(left.shape, generator=generator), alpha=0.05)
+            right.add_(torch.randn(right.shape, generator=generator), alpha=0.05)
+            grad = left @ right / args.rank ** 0.5 + 0.01 * torch.randn(shape, generator=generator)
+            p.grad = grad.to(dtype=dtype, device=device)
+            m.mul_(beta1).add_(p.grad.float(), alpha=1 - beta1)
+            sq.mul_(beta2).addcmul_(p.grad.float(), p.grad.float(), value=1 - beta2)
+            elapsed = timed(opt.step, device)
+            if step > 0:
+                seconds += elapsed
+        state = opt.state[p]
+        rows.append(dict(shape=name, m=shape[0], n=shape[1], rank=args.rank,
+                         ms_per_step=1e3 * seconds / max(1, args.steps - 1),
+                         m_rel_error=relative_error(state["m_A"] @ state["m_B"], m),
+                         m_floor=truncation_error(m, args.rank),
+                         sq_rel_error=relative_error(state["sq_A"] @ state["sq_B"], sq),
+                         sq_floor=truncation_error(sq, args.rank)))
+    report(rows, args.json)
+
+
+def bench_range_finder(args):
+    """randomized_svd wall time and reconstruction error per (oversample, n_iter) setting."""
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    rows = []
+    for name, shape in llama_shapes(args.scale, args.shapes).items():
+        generator = torch.Generator().manual_seed(args.seed)
+        A = synthetic_grad(shape, dtype, generator=generator).to(device)
+        energy = torch.linalg.svdvals(A.float()).square()
+        optimal = (energy[args.rank:].sum() / energy.sum()).sqrt().item()
+        for oversample in args.oversample:
+            for n_iter in args.n_iter:
+                workspace = optim.svd_workspace(*shape, args.rank, oversample, dtype=dtype, device=device, n_iter=n_iter)
+                out = [None]
+
+                def run():
+                    out[0] = optim.randomized_svd(A, args.rank, oversample=oversample, workspace=workspace, n_iter=n_iter)
+
+                run()  # warm-up
+                seconds = sum(timed(run, device) for _ in range(args.steps))
+                rows.append(dict(shape=name, m=shape[0], n=shape[1], rank=args.rank, oversample=oversample,
+                                 n_iter=n_iter, ms_per_call=1e3 * seconds / args.steps,
+                                 rel_error=relative_error(optim.reconstruct(*out[0]), A), optimal_error=optimal))
+    report(rows, args.json)
+
+
+def bench_nmf(args):
+    """Warm-started nmf against randomized_svd as the compressor of a running second moment.
+
+    Both track the same exact EMA of squared gradients; every step the SVD
+    starts afresh while each nmf setting refines its previous factors.
+    ``min_value`` is the smallest entry of the reconstruction, which the SVD
+    lets go negative.
+    """
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    beta2 = 0.999
+    rows = []
+    for name, shape in llama_shapes(args.scale, args.shapes).items():
+        generator = torch.Generator().manual_seed(args.seed)
+        grads = [synthetic_grad(shape, dtype, generator=generator).to(device) for _ in range(args.steps)]
+        settings = [("randomized_svd", None, 0)] + [("nmf", method, n_iter)
+                                                   for method in ("als", "mu") for n_iter in (1, 2, 4)]
+        for compressor, method, n_iter in settings:
+            exact = torch.zeros(shape, device=device)
+            factors, seconds = None, 0.0
+            for step, grad in enumerate(grads):
+                exact.mul_(beta2).addcmul_(grad.float(), grad.float(), value=1 - beta2)
+                out = [None]
+                if compressor == "randomized_svd" or factors is None:
+                    def run():
+                        out[0] = optim.randomized_svd(exact, args.rank, oversample=4)
+                else:
+                    def run():
+                        out[0] = optim.nmf(exact, *factors, args.rank, n_iter, method=method)
+                elapsed = timed(run, device)
+                if step > 0:  # the first nmf step is seeded by a randomized SVD
+                    seconds += elapsed
+                factors = out[0]
+            approx = optim.reconstruct(*factors)
+            rows.append(dict(shape=name, m=shape[0], n=shape[1], rank=args.rank, compressor=compressor,
+                             method=method, n_iter=n_iter, ms_per_call=1e3 * seconds / max(1, args.steps - 1),
+                             rel_error=relative_error(approx, exact), min_value=approx.min().item()))
+    report(rows, args.json)
+
+
+GALORE_REFRESH_MODES = {
+    "svd": dict(refresh="svd"),
+    "randomized": dict(refresh="randomized", oversample=4),
+    "warm_start": dict(refresh="randomized", oversample=4, warm_start=True),
+}
+
+
+def bench_galore_refresh(args):
+    """GaLore step-time profile per refresh mode, with and without staggered refreshes."""
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    shapes = list(llama_shapes(args.scale, args.shapes).values()) * args.layers
+    rows = []
+    for mode, kwargs in GALORE_REFRESH_MODES.items():
+        for stagger in (False, True):
+            generator = torch.Generator().manual_seed(args.seed)
+            params = [torch.nn.Parameter(torch.zeros(shape, dtype=dtype, device=device)) for shape in shapes]
+            opt = optim.GaLore(params, lr=1e-5, weight_decay=0.0, rank=args.rank, T=args.galore_T, stagger=stagger, **kwargs)
+            grads = [synthetic_grad(shape, dtype, generator=generator).to(device) for shape in shapes]
+            times = []
+            for step in range(args.steps):
+                for p, grad in zip(params, grads):
+                    p.grad = grad
+                times.append(1e3 * timed(opt.step, device))
+            times = sorted(times[1:])  # the first step refreshes every matrix in any mode
+            rows.append(dict(refresh=mode, stagger=stagger, matrices=len(params), T=args.galore_T,
+                             mean_ms=sum(times) / len(times), median_ms=times[len(times) // 2], max_ms=times[-1]))
+    report(rows, args.json)
+
+
+def bench_galore_memory(args):
+    """GaLore state bytes over the full Llama-2-7B parameter list, per projection side."""
+    element = torch.empty((), dtype=getattr(torch, args.dtype)).element_size()
+    params = list(llama2_7b_parameters(args.scale))
+    totals = {}
+    for side in ("left", "right", "auto"):
+        totals[side] = element * sum(math.prod(s) for _, shape in params
+                                     for s in optim.galore_state_shapes(shape, args.rank, side))
+    rows = [dict(proj_side=side, rank=args.rank, dtype=args.dtype, matrices=len(params),
+                 state_gib=total / 2 ** 30, saved_vs_left_gib=(totals["left"] - total) / 2 ** 30)
+            for side, total in totals.items()]
+    report(rows, args.json)
+
+
+KERNEL_OPTIMIZERS = {
+    "MLorc_AdamW2": optim.MLorc_AdamW2,
+    "MLorc_Lion": optim.MLorc_Lion,
+    "GaLore": optim.GaLore,
+    "MLorc_AdamW": optim.MLorc_AdamW,
+}
+
+
+def bench_kernels(args):
+    """Eager against torch.compile'd step kernels, per optimizer and shape.
+
+    The first step, which pays for compilation in compiled mode, is reported
+    apart from the steady-state ms/step. The final parameters of both modes
+    are compared to check the compiled kernels compute the same update.
+    """
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    rows = []
+    for name, shape in llama_shapes(args.scale, args.shapes).items():
+        for opt_name, cls in KERNEL_OPTIMIZERS.items():
+            result = {}
+            for compiled in (False, True):
+                generator = torch.Generator().manual_seed(args.seed)
+                torch.manual_seed(args.seed)
+                p = torch.nn.Parameter(torch.zeros(shape, dtype=dtype, device=device))
+                opt = cls([p], lr=1e-5, rank=args.rank, compiled=compiled)
+                times = []
+                for step in range(args.steps):
+                    p.grad = synthetic_grad(shape, dtype, generator=generator).to(device)
+                    times.append(timed(opt.step, device))
+                result[compiled] = p.detach().clone()
+                rows.append(dict(shape=name, m=shape[0], n=shape[1], optimizer=opt_name, compiled=compiled,
+                                 first_step_ms=1e3 * times[0],
+                                 ms_per_step=1e3 * sum(times[1:]) / max(1, args.steps - 1),
+                                 param_rel_diff=relative_error(result[compiled], result[False])))
+    report(rows, args.json)
+
+
+def bench_workers(args):
+    """ms/step of the per-matrix optimizers with their updates spread over a thread pool of --workers threads."""
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    shapes = list(llama_shapes(args.scale, args.shapes).values()) * args.layers
+    rows = []
+    for opt_name, cls in KERNEL_OPTIMIZERS.items():
+        for workers in args.workers:
+            generator = torch.Generator().manual_seed(args.seed)
+            params = [torch.nn.Parameter(torch.zeros(shape, dtype=dtype, device=device)) for shape in shapes]
+            opt = cls(params, lr=1e-5, rank=args.rank, workers=workers)
+            grads = [synthetic_grad(shape, dtype, generator=generator).to(device) for shape in shapes]
+            seconds = 0.0
+            for step in range(args.steps):
+                for p, grad in zip(params, grads):
+                    p.grad = grad
+                elapsed = timed(opt.step, device)
+                if step > 0:
+                    seconds += elapsed
+            rows.append(dict(optimizer=opt_name, workers=workers, intra_op_threads=opt.intra_op_threads,
+                             matrices=len(params), ms_per_step=1e3 * seconds / max(1, args.steps - 1)))
+    report(rows, args.json)
+
+
+def bench_sketch(args):
+    """ms/step per --sketch-refresh with seeded sketches, and whether two runs agree bit for bit.
+
+    The second run uses another global seed and a thread pool of two workers,
+    so it only reproduces the first if every test matrix comes from the
+    optimizer's own per-matrix generators.
+    """
+    device, dtype = torch.device(args.device), getattr(torch, args.dtype)
+    shapes = list(llama_shapes(args.scale, args.shapes).values()) * args.layers
+    rows = []
+    for opt_name, cls in KERNEL_OPTIMIZERS.items():
+        for refresh in args.sketch_refresh:
+            weights, seconds = [], 0.0
+            for run, workers in enumerate((0, 2)):
+                torch.manual_seed(args.seed + run)
+                generator = torch.Generator().manual_seed(args.seed)
+                params = [torch.nn.Parameter(torch.zeros(shape, dtype=dtype, device=device)) for shape in shapes]
+                opt = cls(params, lr=1e-5, rank=args.rank, workers=workers, sketch_seed=args.seed, sketch_refresh=refresh)
+                grads = [synthetic_grad(shape, dtype, generator=generator).to(device) for shape in shapes]
+                for step in range(args.steps):
+                    for p, grad in zip(params, grads):
+                        p.grad = grad
+                    elapsed = timed(opt.step, device)
+                    if run == 0 and step > 0:
+                        seconds += elapsed
+                weights.append(torch.cat([p.detach().flatten() for p in params]))
+            rows.append(dict(optimizer=opt_name, sketch_refresh=refresh, matrices=len(shapes),
+                             ms_per_step=1e3 * seconds / max(1, args.steps - 1),
+                             reproducible=torch.equal(weights[0], weights[1])))
+    report(rows, args.json)
+
+
+# name: (optimizer class, whether it takes a rank, index in betas of the momentum it stores)
+SUITE_OPTIMIZERS = {
+    "MLorc_AdamW2": (optim.MLorc_AdamW2, True, 0),
+    "MLorc_Lion": (optim.MLorc_Lion, True, 1),
+    # row-tiled steps, whose dense temporaries are tile_size x n instead of m x n
+    "MLorc_AdamW2_tiled": (functools.partial(optim.MLorc_AdamW2, tile_size=256), True, 0),
+    "MLorc_Lion_tiled": (functools.partial(optim.MLorc_Lion, tile_size=256), True, 1),
+    # without factor_update MLorc_AdamW's m_A/m_B stay zero, so there would be no stored momentum to compare
+    "MLorc_AdamW": (functools.partial(optim.MLorc_AdamW, factor_update=True), True, 0),
+    "GaLore": (optim.GaLore, True, 0),
+    "AdamW": (torch.optim.AdamW, False, 0),
+}
+if Lion is not None:
+    SUITE_OPTIMIZERS["Lion"] = (Lion, False, 1)
+
+
+def peak_memory(device):
+    """Peak memory so far in bytes: allocated CUDA memory, or the process' max RSS on CPU."""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KiB on Linux
+
+
+def suite_run(config):
+    """One suite configuration; on CPU this runs in a fresh process so ru_maxrss is its own."""
+    device, dtype = torch.device(config["device"]), getattr(torch, config["dtype"])
+    cls, low_rank, beta_index = SUITE_OPTIMIZERS[config["optimizer"]]
+    kwargs = dict(rank=config["rank"]) if low_rank else {}
+    # a couple of steps on a small matrix first, so lazily loaded libraries and
+    # kernels do not show up as optimizer memory
+    size = 2 * max(32, config["rank"] or 0)
+    warm = torch.nn.Parameter(torch.zeros(size, size, dtype=dtype, device=device))
+    warm_opt = cls([warm], lr=1e-5, weight_decay=0.0, **kwargs)
+    for _ in range(2):
+        warm.grad = torch.randn_like(warm)
+        warm_opt.step()
+    del warm, warm_opt
+
+    torch.manual_seed(config["seed"])
+    generator = torch.Generator().manual_seed(config["seed"])
+    params = [torch.nn.Parameter(torch.zeros(shape, dtype=dtype, device=device)) for shape in config["shapes"]]
+    exact = [torch.zeros(p.shape, device=device) for p in params]
+    for p in params:
+        p.grad = synthetic_grad(p.shape, dtype, generator=generator).to(device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    # params, gradients and the exact float32 momentum, before any optimizer state
+    baseline = torch.cuda.memory_allocated(device) if device.type == "cuda" else peak_memory(device)
+
+    opt = cls(params, lr=1e-5, weight_decay=0.0, **kwargs)
+    beta = opt.param_groups[0]["betas"][beta_index]
+    seconds = 0.0
+    for step in range(config["steps"]):
+        if step > 0:
+            for p in params:
+                p.grad = synthetic_grad(p.shape, dtype, generator=generator).to(device)
+        for p, m in zip(params, exact):
+            m.mul_(beta).add_(p.grad.float(), alpha=1 - beta)
+        elapsed = timed(opt.step, device)
+        if step > 0:  # the first step pays for state and workspace allocation
+            seconds += elapsed
+    errors = [relative_error(first_moment_estimate(opt, p), m) for p, m in zip(params, exact)]
+    return dict(optimizer=config["optimizer"], rank=config["rank"] if low_rank else None, dtype=config["dtype"],
+                matrices=len(params), ms_per_step=1e3 * seconds / max(1, config["steps"] - 1),
+                baseline_mib=baseline / 2 ** 20, peak_mib=peak_memory(device) / 2 ** 20,
+                state_mib=sum(state_bytes(opt.state[p]) for p in params) / 2 ** 20,
+                m_rel_error=sum(errors) / len(errors))
+
+
+def bench_suite(args):
+    """Sweep optimizer x rank x dtype: ms/step, peak memory, state size and first-moment error.
+
+    Every configuration steps one matrix per selected Llama-2-7B shape (times
+    --layers). On CUDA, peak memory is torch.cuda.max_memory_allocated; on CPU
+    each configuration runs in its own spawned process and reports its max
+    RSS. baseline_mib is the same measure taken after the params, gradients
+    and the exact float32 reference momentum are allocated, before the
+    optimizer exists. m_rel_error compares the momentum the optimizer stores
+    with the exact exponential moving average of the gradients.
+    """
+    device = torch.device(args.device)
+    shapes = list(llama_shapes(args.scale, args.shapes).values()) * args.layers
+    configs = []
+    for name in args.optimizers:
+        low_rank = SUITE_OPTIMIZERS[name][1]
+        for rank in (args.ranks or [args.rank]) if low_rank else [None]:
+            for dtype in args.dtypes or [args.dtype]:
+                configs.append(dict(optimizer=name, rank=rank, dtype=dtype, shapes=shapes, steps=args.steps,
+                                    device=args.device, seed=args.seed))
+    if device.type == "cuda":
+        rows = [suite_run(config) for config in configs]
+    else:
+        rows = []
+        for config in configs:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                rows.append(pool.submit(suite_run, config).result())
+    report(rows, args.json)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=0.25, help="multiply every Llama-2-7B dimension by this")
+    parser.add_argument("--shapes", nargs="+", choices=list(LLAMA2_7B_SHAPES), help="subset of layer shapes")
+    parser.add_argument("--rank", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="one JSON object per result line")
+    parser.add_argument("--oversample", type=int, nargs="+", default=[0, 4, 8], help="range_finder: oversampling settings")
+    parser.add_argument("--n-iter", type=int, nargs="+", default=[0, 1, 2], help="range_finder: power iteration settings")
+    parser.add_argument("--layers", type=int, default=2, help="galore_refresh, suite, workers: copies of every layer shape")
+    parser.add_argument("--galore-T", type=int, default=8, help="galore_refresh: projector refresh period")
+    parser.add_argument("--optimizers", nargs="+", choices=list(SUITE_OPTIMIZERS), default=list(SUITE_OPTIMIZERS),
+                        help="suite: optimizers to sweep")
+    parser.add_argument("--ranks", type=int, nargs="+", help="suite: ranks to sweep (default --rank)")
+    parser.add_argument("--dtypes", nargs="+", choices=["float32", "bfloat16"], help="suite: dtypes to sweep (default --dtype)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4, 8], help="workers: thread pool sizes to sweep")
+    parser.add_argument("--sketch-refresh", type=int, nargs="+", default=[1, 4, 16],
+                        help="sketch: steps each seeded test matrix is reused for")
+    benchmarks = {
+        "second_moment": bench_second_moment,
+        "range_finder": bench_range_finder,
+        "nmf": bench_nmf,
+        "galore_refresh": bench_galore_refresh,
+        "galore_memory": bench_galore_memory,
+        "quantized_factors": bench_quantized_factors,
+        "factor_update": bench_factor_update,
+        "kernels": bench_kernels,
+        "suite": bench_suite,
+        "workers": bench_workers,
+        "sketch": bench_sketch,
+    }
+    parser.add_argument("benchmark", choices=list(benchmarks))
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    benchmarks[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""Sharded safetensors checkpoints of optimizer state, keyed by parameter name.
+
+Every tensor in ``optimizer.state[p]`` is written as ``"<param name>/<state key>"``
+into a set of safetensors shards, with all the tensors of one parameter kept
+in the same shard. Scalars (``step``, ``refresh_offset``, ...), the param
+group hyperparameters and the ranks and spectra of a ``RankAllocator`` go
+into a JSON index next to the shards. The generator states and reused
+columns of an optimizer's ``SketchProvider`` get a small file of their own,
+so runs with a ``sketch_seed`` resume drawing the same test matrices.
+
+Loading replaces ``optimizer.state`` with a ``LazyState``: nothing is read up
+front, and a parameter's tensors are pulled out of the memory-mapped shard
+the first time the optimizer looks its state up.
+
+    save_optimizer_state(optimizer, model.named_parameters(), "ckpt/optimizer")
+    load_optimizer_state(optimizer, model.named_parameters(), "ckpt/optimizer")
+"""
+import json
+import os
+from collections import defaultdict
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+INDEX_NAME = "optimizer_state.index.json"
+SHARD_NAME = "optimizer_state-{:05d}-of-{:05d}.safetensors"
+SKETCH_NAME = "optimizer_sketches-{:05d}.safetensors"
+# optimizer attributes that resumed runs continue from, e.g. GaLore's count of matrices given a stagger offset
+COUNTERS = ("_matrices",)
+
+
+def _optimizers(optimizer):
+    return list(optimizer) if isinstance(optimizer, (list, tuple)) else [optimizer]
+
+
+def _param_names(named_parameters):
+    return {p: name for name, p in named_parameters}
+
+
+def _flatten(state, prefix=""):
+    # nested dicts such as MLorc_AdamW's cached Grams become dotted keys
+    flat = {}
+    for k, v in state.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + "."))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+def _unflatten(flat):
+    state = {}
+    for k, v in flat.items():
+        *outer, key = k.split(".")
+        target = state
+        for o in outer:
+            target = target.setdefault(o, {})
+        target[key] = v
+    return state
+
+
+def _allocator_state(optimizer, names):
+    allocator = getattr(optimizer, "rank_allocator", None)
+    if allocator is None:
+        return None
+    layers = {names[p]: dict(rank=layer["rank"], spectrum=None if layer["spectrum"] is None else layer["spectrum"].tolist())
+              for p, layer in allocator.layers.items()}
+    return dict(steps=allocator.steps, layers=layers)
+
+
+def _load_allocator_state(optimizer, named_parameters, saved):
+    # the loaded state never goes through _init_state, so its parameters are registered here, at their saved ranks
+    allocator = getattr(optimizer, "rank_allocator", None)
+    if allocator is None or saved is None:
+        return
+    allocator.steps = saved["steps"]
+    for name, p in named_parameters:
+        layer = saved["layers"].get(name)
+        if layer is None:
+            continue
+        optimizer._register_rank(p, layer["rank"])
+        if layer["spectrum"] is not None:
+            allocator.observe(p, torch.tensor(layer["spectrum"]))
+
+
+def _sketch_state(optimizer, directory, i):
+    sketches = getattr(optimizer, "sketches", None)
+    if sketches is None:
+        return None
+    state = sketches.state_dict()
+    tensors = {"generators/" + k: g for k, g in state["generators"].items()}
+    tensors.update({"cached/" + k: out.detach().contiguous().cpu() for k, (out, _) in state["cached"].items()})
+    filename = None
+    if tensors:
+        filename = SKETCH_NAME.format(i + 1)
+        save_file(tensors, os.path.join(directory, filename))
+    return dict(file=filename, calls={k: calls for k, (_, calls) in state["cached"].items()})
+
+
+def _load_sketch_state(optimizer, directory, saved):
+    sketches = getattr(optimizer, "sketches", None)
+    if sketches is None or saved is None or saved["file"] is None:
+        return
+    state = dict(generators={}, cached={})
+    with safe_open(os.path.join(directory, saved["file"]), framework="pt") as f:
+        for name in f.keys():
+            kind, key = name.split("/", 1)
+            t = f.get_tensor(name)
+            state[kind][key] = t if kind == "generators" else (t, saved["calls"][key])
+    sketches.load_state_dict(state)
+
+
+def save_optimizer_state(optimizer, named_parameters, directory, max_shard_bytes=2 * 2 ** 30, metadata=None):
+    """Write the state of ``optimizer`` (or a list of optimizers) to ``directory``.
+
+    ``named_parameters`` gives the names the state is keyed by, typically
+    ``model.named_parameters()``. ``metadata`` is any JSON-serialisable dict
+    stored alongside, e.g. the scheduler state; ``load_optimizer_state``
+    returns it.
+    """
+    names = _param_names(named_parameters)
+    optimizers = _optimizers(optimizer)
+    os.makedirs(directory, exist_ok=True)
+
+    param_groups, entries = [], []
+    for opt in optimizers:
+        for group in opt.param_groups:
+            param_groups.append(dict({k: v for k, v in group.items() if k != "params"},
+                                     params=[names[p] for p in group["params"]]))
+            for p in group["params"]:
+                state = _flatten(opt.state[p])
+                if len(state) == 0:
+                    continue
+                tensors = {k: v for k, v in state.items() if torch.is_tensor(v)}
+                scalars = {k: v for k, v in state.items() if not torch.is_tensor(v)}
+                nbytes = sum(t.numel() * t.element_size() for t in tensors.values())
+                entries.append((names[p], tensors, scalars, nbytes))
+
+    # greedy sharding in parameter order, one parameter never straddles two shards
+    shards, size = [[]], 0
+    for entry in entries:
+        if shards[-1] and size + entry[3] > max_shard_bytes:
+            shards.append([])
+            size = 0
+        shards[-1].append(entry)
+        size += entry[3]
+
+    index = dict(metadata=metadata or {}, param_groups=param_groups, state={},
+                 rank_allocators=[_allocator_state(opt, names) for opt in optimizers],
+                 sketches=[_sketch_state(opt, directory, i) for i, opt in enumerate(optimizers)],
+                 counters=[{k: getattr(opt, k) for k in COUNTERS if hasattr(opt, k)} for opt in optimizers])
+    for i, shard in enumerate(shards):
+        filename = SHARD_NAME.format(i + 1, len(shards))
+        tensors = {}
+        for name, state_tensors, scalars, _ in shard:
+            for k, t in state_tensors.items():
+                tensors["{}/{}".format(name, k)] = t.detach().contiguous().cpu()
+            index["state"][name] = dict(shard=filename, tensors=sorted(state_tensors), scalars=scalars)
+        save_file(tensors, os.path.join(directory, filename))
+    with open(os.path.join(directory, INDEX_NAME), "w") as f:
+        json.dump(index, f, indent=2)
+
+
+class LazyState(defaultdict):
+    """``optimizer.state`` that reads a parameter's saved state on first access.
+
+    Shards are opened (memory-mapped) once, on the first parameter that needs
+    them, and only the tensors of the accessed parameter are materialised, on
+    that parameter's device. Parameters without saved state start empty, as
+    with a plain ``defaultdict(dict)``.
+    """
+
+    def __init__(self, names, directory, index):
+        super().__init__(dict)
+        self._names = names
+        self._directory = directory
+        self._index = index
+        self._shards = {}
+
+    def _shard(self, filename):
+        handle = self._shards.get(filename)
+        if handle is None:
+            handle = self._shards[filename] = safe_open(os.path.join(self._directory, filename), framework="pt")
+        return handle
+
+    def __missing__(self, p):
+        entry = self._index.get(self._names.get(p))
+        flat = {}
+        if entry is not None:
+            handle = self._shard(entry["shard"])
+            name = self._names[p]
+            flat.update(entry["scalars"])
+            for k in entry["tensors"]:
+                flat[k] = handle.get_tensor("{}/{}".format(name, k)).to(p.device)
+        state = self[p] = _unflatten(flat)
+        return state
+
+    def load_all(self):
+        """Read every saved entry that has not been accessed yet."""
+        for p, name in self._names.items():
+            if name in self._index and p not in self:
+                self[p]
+        return self
+
+    def __reduce__(self):
+        # shard handles are not picklable, so copies and pickles become a plain, fully loaded defaultdict
+        return (defaultdict, (dict,), None, None, iter(self.load_all().items()))
+
+
+def load_optimizer_state(optimizer, named_parameters, directory):
+    """Restore the state written by ``save_optimizer_state`` into ``optimizer``, lazily.
+
+    Param group hyperparameters, rank allocators, sketch generators and
+    counters are restored immediately, matching groups in order;
+    per-parameter state is only read when the optimizer first uses it.
+    Returns the saved ``metadata``.
+    """
+    named_parameters = list(named_parameters)
+    names = _param_names(named_parameters)
+    with open(os.path.join(directory, INDEX_NAME)) as f:
+        index = json.load(f)
+
+    groups = [group for opt in _optimizers(optimizer) for group in opt.param_groups]
+    if len(groups) != len(index["param_groups"]):
+        raise ValueError("Checkpoint has {} param groups, the optimizer {}".format(len(index["param_groups"]), len(groups)))
+    for group, saved in zip(groups, index["param_groups"]):
+        if saved["params"] != [names[p] for p in group["params"]]:
+            raise ValueError("Param group parameters do not match the checkpoint")
+        for k, v in saved.items():
+            if k != "params":
+                group[k] = tuple(v) if isinstance(group.get(k), tuple) else v
+
+    allocators = index.get("rank_allocators", [])
+    sketches = index.get("sketches", [])
+    counters = index.get("counters", [])
+    for i, opt in enumerate(_optimizers(optimizer)):
+        opt.state = LazyState(names, directory, index["state"])
+        _load_allocator_state(opt, named_parameters, allocators[i] if i < len(allocators) else None)
+        _load_sketch_state(opt, directory, sketches[i] if i < len(sketches) else None)
+        for k, v in (counters[i] if i < len(counters) else {}).items():
+            setattr(opt, k, v)
+    return index["metadata"]
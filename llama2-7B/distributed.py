@@ -0,0 +1,313 @@
+"""Data-parallel helpers for the optimizers in optim.py.
+
+``ShardedOptimizer`` splits the optimizer state ZeRO-1 style: every rank
+keeps the state of, and runs the step (randomized SVDs included) for, only
+the parameters it owns, then each owner broadcasts its updated weights. The
+gradients must already agree across ranks, e.g. because the model is wrapped
+in ``DistributedDataParallel``:
+
+    model = DDP(model)
+    optimizer = ShardedOptimizer(MLorc_AdamW2(model.parameters(), rank=4))
+    scheduler = get_linear_schedule_with_warmup(optimizer.optimizer, ...)
+
+``powersgd_hook`` is a DDP communication hook that all-reduces rank-``r``
+factors of every large enough 2-D gradient instead of the gradient itself:
+
+    state = PowerSGDState(rank=4)
+    model.register_comm_hook(state, powersgd_hook)
+    ...
+    state.report()  # bytes sent per step against a dense all-reduce
+
+Everything runs on the ``gloo`` backend, so a multi-process CPU run checks it:
+
+    python distributed.py --world-size 4 --optimizer MLorc_Lion --steps 5
+    python distributed.py --world-size 2 --powersgd-rank 4
+"""
+import argparse
+import contextlib
+import heapq
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+import optim
+
+
+def partition_parameters(params, world_size):
+    """Owner rank per parameter, balancing the elements each rank steps (largest first, to the least loaded)."""
+    loads = [(0, rank) for rank in range(world_size)]
+    owners = {}
+    for p in sorted(params, key=lambda p: -p.numel()):
+        load, rank = heapq.heappop(loads)
+        owners[p] = rank
+        heapq.heappush(loads, (load + p.numel(), rank))
+    return owners
+
+
+class ShardedOptimizer:
+    """Runs ``optimizer`` on this rank's share of the parameters and broadcasts the results.
+
+    Parameters are assigned to ranks by ``partition_parameters``. ``step``
+    updates the owned parameters through the wrapped optimizer, so only their
+    state is ever created and optimizer memory and compute per rank scale as
+    ``1 / world_size``; then every parameter is broadcast from its owner.
+    Weights rather than low-rank deltas are sent: the Adam and Lion updates
+    are full rank even when the momenta are not. Param groups are shared
+    with the wrapped optimizer, so a scheduler built on ``optimizer`` drives
+    every rank.
+
+    Arguments:
+        optimizer (Optimizer): optimizer over all parameters, identical on every rank.
+        process_group (optional): data-parallel group (default: the world).
+    """
+
+    def __init__(self, optimizer, process_group=None):
+        self.optimizer = optimizer
+        self.process_group = process_group
+        self.rank = dist.get_rank(process_group)
+        self.world_size = dist.get_world_size(process_group)
+        params = [p for group in optimizer.param_groups for p in group["params"]]
+        self.owners = partition_parameters(params, self.world_size)
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    @contextlib.contextmanager
+    def _owned_groups(self):
+        # the wrapped optimizer only sees this rank's parameters, with the real groups' hyperparameters
+        param_groups = self.optimizer.param_groups
+        self.optimizer.param_groups = [dict(group, params=[p for p in group["params"] if self.owners[p] == self.rank])
+                                       for group in param_groups]
+        try:
+            yield
+        finally:
+            self.optimizer.param_groups = param_groups
+
+    def step(self, closure=None):
+        """Update the owned parameters, then broadcast every parameter from its owner."""
+        with self._owned_groups():
+            loss = self.optimizer.step(closure)
+        self._broadcast()
+        return loss
+
+    def _broadcast(self):
+        handles = []
+        for group in self.optimizer.param_groups:
+            for p in group["params"]:
+                src = dist.get_global_rank(self.process_group, self.owners[p]) if self.process_group is not None else self.owners[p]
+                handles.append(dist.broadcast(p.data, src=src, group=self.process_group, async_op=True))
+        for handle in handles:
+            handle.wait()
+
+    def zero_grad(self, set_to_none=True):
+        self.optimizer.zero_grad(set_to_none=set_to_none)
+
+    def memory_report(self, named_parameters=None):
+        """``optim.optimizer_memory`` of this rank's shard."""
+        with self._owned_groups():
+            return optim.optimizer_memory(self.optimizer, named_parameters)
+
+
+class PowerSGDState:
+    """State of ``powersgd_hook``: per-matrix sketches and error feedback, and traffic counters.
+
+    Every gradient ``G`` of an ``m x n`` matrix is compressed PowerSGD style
+    (Vogels et al., 2019) with one power iteration: ``M = G + E`` is sketched
+    as ``P = M @ Omega``, ``P`` is all-reduced and orthonormalized
+    (``optim.orthonormalize``), ``Omega = M^T P`` is all-reduced, and the
+    gradient becomes ``P @ Omega^T``. ``E`` keeps what the approximation
+    missed for the next step, and ``Omega`` is kept as the next step's test
+    matrix, warm-starting the range finder. The first ``Omega`` comes from
+    ``optim.sketch_matrix`` with a generator seeded by ``seed``, so it is
+    the same on every rank. Tensors that are not matrices or that would
+    not shrink by ``min_compression_rate`` are all-reduced densely.
+
+    Arguments:
+        process_group (optional): data-parallel group (default: the world).
+        rank (int): rank of the all-reduced factors.
+        min_compression_rate (float): only compress when ``m * n >= min_compression_rate * (m + n) * rank``.
+        seed (int): seed of the initial test matrices, identical on every rank.
+    """
+
+    def __init__(self, process_group=None, rank=4, min_compression_rate=2, seed=0):
+        if rank < 1:
+            raise ValueError("Invalid rank: {} - should be >= 1".format(rank))
+        self.process_group = process_group
+        self.rank = rank
+        self.min_compression_rate = min_compression_rate
+        self.seed = seed
+        self.errors = {}
+        self.workspaces = {}
+        self.steps = 0
+        self.bytes_sent = 0
+        self.dense_bytes = 0
+
+    def compresses(self, p):
+        return p.dim() == 2 and p.numel() >= self.min_compression_rate * sum(p.shape) * self.rank
+
+    def workspace(self, p):
+        """Float32 ``optim.svd_workspace`` of ``p``; its ``omega`` is the persistent test matrix."""
+        workspace = self.workspaces.get(p)
+        if workspace is None:
+            workspace = self.workspaces[p] = optim.svd_workspace(*p.shape, self.rank, device=p.device)
+            generator = torch.Generator(device=p.device).manual_seed(self.seed)
+            optim.sketch_matrix(p.shape[1], self.rank, out=workspace["omega"], generator=generator)
+            self.errors[p] = torch.zeros(p.shape, device=p.device)
+        return workspace
+
+    def report(self):
+        """Bytes all-reduced per step by the hook and by a dense all-reduce of the same gradients."""
+        steps = max(1, self.steps)
+        return dict(steps=self.steps, bytes_per_step=self.bytes_sent / steps, dense_bytes_per_step=self.dense_bytes / steps,
+                    compression=self.dense_bytes / max(1, self.bytes_sent))
+
+
+def powersgd_hook(state, bucket):
+    """DDP communication hook all-reducing low-rank factors of the matrix gradients, see ``PowerSGDState``."""
+    group = state.process_group
+    world_size = dist.get_world_size(group)
+    buffer = bucket.buffer()
+    params = bucket.parameters()
+    grads = [g.view(p.shape) for g, p in zip(buffer.split([p.numel() for p in params]), params)]
+    matrices = [(p, g) for p, g in zip(params, grads) if state.compresses(p)]
+    dense = [g for p, g in zip(params, grads) if not state.compresses(p)]
+
+    Ms, workspaces = [], []
+    for p, g in matrices:
+        workspace = state.workspace(p)
+        M = state.errors[p].add_(g)  # error feedback: M = G + E, in E's buffer
+        torch.matmul(M, workspace["omega"], out=workspace["Y"])
+        Ms.append(M)
+        workspaces.append(workspace)
+    # the first all-reduce carries the sketches and the dense tensors together
+    first = torch.cat([w["Y"].flatten() for w in workspaces] + [g.flatten().float() for g in dense])
+    second = torch.empty(sum(w["omega"].numel() for w in workspaces), device=buffer.device)
+    state.bytes_sent += (first.numel() + second.numel()) * first.element_size()
+    state.dense_bytes += buffer.numel() * buffer.element_size()
+    if bucket.is_last():
+        state.steps += 1
+
+    # DDP gets this future back; the callbacks below complete it once the second all-reduce is in. They
+    # never wait() on a collective themselves, which can deadlock the gloo backend's callback thread.
+    result = torch.futures.Future()
+
+    def forward_errors(fn):
+        def callback(fut):
+            try:
+                fn(fut)
+            except Exception as e:
+                result.set_exception(e)
+        return callback
+
+    def orthonormalize_and_project(fut):
+        reduced = fut.value()[0].div_(world_size)
+        offset = 0
+        for M, workspace in zip(Ms, workspaces):
+            Y = workspace["Y"]
+            Y.copy_(reduced[offset:offset + Y.numel()].view_as(Y))
+            offset += Y.numel()
+            P = optim.orthonormalize(Y, workspace)
+            torch.matmul(M.mT, P, out=workspace["omega"])
+        for g in dense:
+            g.copy_(reduced[offset:offset + g.numel()].view_as(g))
+            offset += g.numel()
+        if not workspaces:
+            result.set_result(buffer)
+            return
+        torch.cat([w["omega"].flatten() for w in workspaces], out=second)
+        dist.all_reduce(second, group=group, async_op=True).get_future().then(forward_errors(decompress))
+
+    def decompress(fut):
+        reduced = fut.value()[0].div_(world_size)
+        offset = 0
+        for (p, g), M, workspace in zip(matrices, Ms, workspaces):
+            omega = workspace["omega"]
+            omega.copy_(reduced[offset:offset + omega.numel()].view_as(omega))
+            offset += omega.numel()
+            approx = workspace["Q"] @ omega.mT
+            M.sub_(approx)  # what the rank-r gradient missed stays in E
+            g.copy_(approx)
+        result.set_result(buffer)
+
+    dist.all_reduce(first, group=group, async_op=True).get_future().then(forward_errors(orthonormalize_and_project))
+    return result
+
+
+OPTIMIZERS = {
+    "MLorc_AdamW2": optim.MLorc_AdamW2,
+    "MLorc_Lion": optim.MLorc_Lion,
+    "MLorc_AdamW": optim.MLorc_AdamW,
+    "GaLore": optim.GaLore,
+}
+
+
+def demo_worker(rank, args):
+    """One process of the ``gloo`` demo: DDP over a stack of linear layers, sharded optimizer state."""
+    dist.init_process_group("gloo", init_method="tcp://127.0.0.1:{}".format(args.port),
+                            rank=rank, world_size=args.world_size)
+    torch.manual_seed(args.seed)  # identical initial weights on every rank
+    model = torch.nn.Sequential(*[torch.nn.Linear(args.hidden, args.hidden, bias=False) for _ in range(args.layers)])
+    ddp = DDP(model)
+    comm_state = None
+    if args.powersgd_rank:
+        comm_state = PowerSGDState(rank=args.powersgd_rank, seed=args.seed)
+        ddp.register_comm_hook(comm_state, powersgd_hook)
+    inner = OPTIMIZERS[args.optimizer](model.parameters(), lr=1e-3, rank=args.rank)
+    optimizer = ShardedOptimizer(inner)
+    torch.manual_seed(args.seed + 1 + rank)  # but different data and sketches
+    seconds = 0.0
+    for step in range(args.steps):
+        x = torch.randn(args.batch_size, args.hidden)
+        loss = ddp(x).square().mean()
+        loss.backward()
+        start = time.perf_counter()
+        optimizer.step()
+        if step > 0:  # the first step pays for state and workspace allocation
+            seconds += time.perf_counter() - start
+        optimizer.zero_grad()
+
+    # every rank must end up with the same weights
+    flat = torch.cat([p.detach().flatten() for p in model.parameters()])
+    spread = flat.clone()
+    dist.all_reduce(spread, op=dist.ReduceOp.MAX)
+    spread -= flat
+    dist.all_reduce(spread, op=dist.ReduceOp.MAX)
+    state = optim.tensor_bytes(dict(inner.state))
+    print("rank {}: {} params owned, state {:.3f} MiB, {:.2f} ms/step, max weight mismatch {:.3g}".format(
+        rank, len(inner.state), state / 2**20, 1e3 * seconds / max(1, args.steps - 1), spread.max().item()))
+    if comm_state is not None and rank == 0:
+        traffic = comm_state.report()
+        print("all-reduce: {:.3f} MiB/step, dense {:.3f} MiB/step ({:.1f}x less)".format(
+            traffic["bytes_per_step"] / 2**20, traffic["dense_bytes_per_step"] / 2**20, traffic["compression"]))
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--world-size", type=int, default=2)
+    parser.add_argument("--optimizer", choices=list(OPTIMIZERS), default="MLorc_AdamW2")
+    parser.add_argument("--rank", type=int, default=4)
+    parser.add_argument("--hidden", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=29511)
+    parser.add_argument("--powersgd-rank", type=int, default=0, help="all-reduce rank-r gradient factors (0: dense)")
+    args = parser.parse_args()
+    # one intra-op thread per process, so the ranks do not compete for the cores
+    os.environ.setdefault("OMP_NUM_THREADS", "1")
+    mp.spawn(demo_worker, args=(args,), nprocs=args.world_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,146 +1,844 @@
+import collections
+import functools
+import heapq
 import math
+import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from torch.optim.optimizer import Optimizer, required
 import torch.nn as nn
 import torch
 
-def nmf(A, U, S, V, rank, max_iter=2, epsilon=1e-12):
-    
-    device = A.device
-    W_init = U @ torch.diag(S.sqrt())
-    H_init = torch.diag(S.sqrt()) @ V.T
-
-    for i in range(max_iter):
-        # 更新 H（固定 W）
-        WT_W = W.T @ W + epsilon * torch.eye(rank, device=device)  # 加 epsilon 防止奇异
-        WT_A = W.T @ A
-        H = torch.linalg.solve(WT_W, WT_A)
-        H = torch.clamp(H, min=0)  # 保证非负
-
-        # 更新 W（固定 H）
-        HH_T = H @ H.T + epsilon * torch.eye(rank, device=device)
-        AH_T = A @ H.T
-        W = torch.linalg.solve(HH_T.T, AH_T.T).T
-        W = torch.clamp(W, min=0)
-
-    S = torch.ones(rank, dtype=A.dtype, device=device)
-    return W, S, H
-
-def randomized_svd(A, rank):
-
-    m, n = A.shape
-    device = A.device
-    random_matrix = torch.randn(size=(n, rank), device=device)
-    datatype = A.dtype
-    
-    Y = A @ random_matrix.to(datatype)
-    Q, _ = torch.linalg.qr(Y.float())
-    Q = Q.to(datatype)
-    B = Q.T @ A
-    U_hat, S, V = torch.linalg.svd(B.float(), full_matrices=False)
-
-    U = Q @ U_hat.to(datatype)
-    S = S.to(datatype)
-    V = V.to(datatype)
-
+def nmf(A, U, S, V, rank, max_iter=2, epsilon=1e-12, method="als"):
+    """Non-negative rank-``rank`` factorization ``A ~ U @ diag(S) @ V`` of a non-negative ``A``.
+
+    Warm-started from ``(U, S, V)`` in the ``randomized_svd`` layout (``U`` is
+    ``m x r``, ``V`` is ``r x n``); signed SVD factors are made non-negative by
+    taking their absolute values. Runs ``max_iter`` iterations of projected
+    alternating least squares (``method="als"``) or of Lee-Seung
+    multiplicative updates (``method="mu"``) in float32, on a matrix or a
+    stack of matrices. Returns non-negative float32 ``(U, S, V)`` with
+    unit-norm columns of ``U`` and rows of ``V`` and ``S`` in decreasing
+    order, so ``reconstruct`` and the rank allocator treat it like an SVD.
+    """
+    A = A.float()
+    root = S.float().abs().sqrt()
+    W = (U.float() * root.unsqueeze(-2)).abs()
+    H = (root.unsqueeze(-1) * V.float()).abs()
+    for _ in range(max_iter):
+        if method == "mu":
+            H = H * (W.mT @ A) / ((W.mT @ W) @ H + epsilon)
+            W = W * (A @ H.mT) / (W @ (H @ H.mT) + epsilon)
+        else:
+            # rank-deficient gradients zero out columns of W / rows of H, leaving their Grams
+            # singular; gram_cholesky then adds just enough jitter to turn the solve into ridge regression
+            H = torch.cholesky_solve(W.mT @ A, gram_cholesky(W.mT @ W)).clamp_(min=0)
+            W = torch.cholesky_solve(H @ A.mT, gram_cholesky(H @ H.mT)).mT.clamp_(min=0)
+    W_norm, H_norm = W.norm(dim=-2), H.norm(dim=-1)
+    S, order = (W_norm * H_norm).sort(dim=-1, descending=True)
+    tiny = torch.finfo(torch.float32).tiny
+    U = (W / W_norm.clamp_min(tiny).unsqueeze(-2)).take_along_dim(order.unsqueeze(-2), dim=-1)
+    V = (H / H_norm.clamp_min(tiny).unsqueeze(-1)).take_along_dim(order.unsqueeze(-1), dim=-2)
     return U, S, V
 
-class MLorc_AdamW2(Optimizer):
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01, correct_bias=True, rank=4):
-        if lr < 0.0:
-            raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
-        if not 0.0 <= betas[0] < 1.0:
-            raise ValueError("Invalid beta parameter: {} - should be in [0.0, 1.0[".format(betas[0]))
-        if not 0.0 <= betas[1] < 1.0:
-            raise ValueError("Invalid beta parameter: {} - should be in [0.0, 1.0[".format(betas[1]))
-        if not 0.0 <= eps:
-            raise ValueError("Invalid epsilon value: {} - should be >= 0.0".format(eps))
-        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias)
+def svd_workspace(m, n, rank, oversample=0, batch=(), dtype=torch.float32, device=None, n_iter=0):
+    """Preallocated buffers for ``randomized_svd`` on ``(*batch, m, n)`` inputs.
+
+    Reusing one workspace across steps keeps the sketch, the QR output and the
+    small SVD in fixed buffers instead of allocating them on every call. The
+    float32 buffers alias the working-precision ones when ``dtype`` is float32.
+    With ``n_iter > 0`` the ``n x k`` buffers of the power iterations are
+    added as well.
+    """
+    k = rank + oversample
+    q = min(m, k)
+    s = min(q, n)
+
+    def buffer(*shape, dt=dtype):
+        return torch.empty((*batch, *shape), dtype=dt, device=device)
+
+    workspace = dict(omega=buffer(n, k), Y=buffer(m, k), Q=buffer(m, q), B=buffer(q, n),
+                     U_hat=buffer(q, min(rank, s)), R=buffer(q, k, dt=torch.float32),
+                     U_f=buffer(q, s, dt=torch.float32), S_f=buffer(s, dt=torch.float32),
+                     V_f=buffer(s, n, dt=torch.float32))
+    if n_iter > 0 and k <= min(m, n):
+        workspace.update(Z=buffer(n, k), P=buffer(n, k), R_P=buffer(k, k, dt=torch.float32))
+    for name in ("Y", "Q", "B", "Z", "P"):
+        if name in workspace:
+            workspace[name + "_f"] = workspace[name] if dtype == torch.float32 else buffer(*workspace[name].shape[len(batch):], dt=torch.float32)
+    return workspace
+
+def sketch_matrix(n, rank, init=None, oversample=0, batch=(), dtype=torch.float32, device=None, out=None, generator=None):
+    """Gaussian ``(*batch, n, rank + oversample)`` test matrix for the range finder.
+
+    The first ``k`` columns are taken from ``init`` (``(*batch, n, k)``) when
+    it is given, so only the remaining columns are drawn at random. With
+    ``out`` the matrix is written into that buffer in place. ``generator``
+    draws the random columns instead of the default generator.
+    """
+    if out is None:
+        out = torch.empty((*batch, n, rank + oversample), dtype=dtype, device=device)
+    if init is not None:
+        out[..., :init.shape[-1]].copy_(init)
+        out[..., init.shape[-1]:].normal_(generator=generator)
+    else:
+        out.normal_(generator=generator)
+    return out
+
+class SketchProvider:
+    """Gaussian test matrices for the range finder, from one seeded generator per key.
+
+    ``for_key(key)`` returns a drop-in for ``sketch_matrix`` that draws from
+    a generator of its own, seeded from ``seed`` and ``key``. Parameters in a
+    key, also inside the tuples of foreach buckets, stand for their position
+    in ``params``, so a key gets the same stream on every run however the
+    matrices are scheduled, e.g. across ``workers`` threads. Without a
+    ``seed`` the default generator is used.
+
+    With ``refresh > 1`` the random columns already in ``out`` are reused for
+    ``refresh`` calls before new ones are drawn, which skips the RNG pass on
+    most steps; warm-start columns from ``init`` are still copied on every
+    call. A new ``out`` buffer (e.g. after a rank change) is always drawn.
+    """
+
+    def __init__(self, params, seed=None, refresh=1):
+        if refresh < 1:
+            raise ValueError("Invalid sketch refresh: {} - should be >= 1".format(refresh))
+        self.seed = seed
+        self.refresh = refresh
+        self._index = {p: i for i, p in enumerate(params)}
+        self._generators = {}
+        # key -> (weak reference to the out buffer holding its random columns, calls since they were drawn);
+        # weak, so buffers that callers drop after one call (GaLore has no workspaces) are neither kept nor saved
+        self._cached = {}
+        # from load_state_dict, by repr(key); each entry is applied the first time its key draws
+        self._saved_generators = {}
+        self._saved_cached = {}
+
+    def _stable_key(self, key):
+        if isinstance(key, tuple):
+            return tuple(self._stable_key(k) for k in key)
+        if torch.is_tensor(key):
+            return self._index.setdefault(key, len(self._index))
+        return key
+
+    def _generator(self, key, device):
+        if self.seed is None:
+            return None
+        generator = self._generators.get(key)
+        if generator is None:
+            # crc32 rather than hash(): string hashes change from one process to the next
+            seed = (self.seed * 2 ** 32 + zlib.crc32(repr(key).encode())) % 2 ** 63
+            generator = self._generators[key] = torch.Generator(device=device).manual_seed(seed)
+            saved = self._saved_generators.pop(repr(key), None)
+            if saved is not None:
+                generator.set_state(saved)
+        return generator
+
+    def state_dict(self):
+        """Generator states and reused random columns by ``repr`` of their key, for ``load_state_dict``."""
+        cached = {}
+        for key, (buffer, calls) in self._cached.items():
+            out = buffer()
+            if out is not None:
+                cached[repr(key)] = (out, calls)
+        return dict(generators={repr(k): g.get_state() for k, g in self._generators.items()}, cached=cached)
+
+    def load_state_dict(self, state):
+        """Continue the streams of a ``state_dict()``, e.g. when resuming from a checkpoint."""
+        self._saved_generators = dict(state["generators"])
+        self._saved_cached = dict(state["cached"])
+
+    def for_key(self, key):
+        """``sketch_matrix`` for the matrix (or bucket) ``key``."""
+        key = self._stable_key(key)
+
+        def sketch(n, rank, init=None, oversample=0, batch=(), dtype=torch.float32, device=None, out=None):
+            if out is not None and self.refresh > 1:
+                saved = self._saved_cached.pop(repr(key), None)
+                if saved is not None and saved[0].shape == out.shape:
+                    out.copy_(saved[0])
+                    self._cached[key] = (weakref.ref(out), saved[1])
+                buffer, calls = self._cached.get(key, (None, 0))
+                if buffer is not None and buffer() is out and calls < self.refresh:
+                    self._cached[key] = (buffer, calls + 1)
+                    if init is not None:
+                        out[..., :init.shape[-1]].copy_(init)
+                    return out
+                self._cached[key] = (weakref.ref(out), 1)
+            device = out.device if out is not None else device
+            return sketch_matrix(n, rank, init, oversample, batch, dtype, device, out, self._generator(key, device))
+        return sketch
+
+def orthonormalize(Y, workspace, names=("Y", "Q", "R")):
+    """Range basis ``Q`` of ``Y`` (float32 QR), written into ``workspace["Q"]``.
+
+    ``names`` selects other buffers of the workspace, e.g. ``("Z", "P", "R_P")``
+    for the row-space half of a power iteration.
+    """
+    y, q, r = names
+    Y_f, Q_f, Q = workspace[y + "_f"], workspace[q + "_f"], workspace[q]
+    if Y_f is not Y:
+        Y_f.copy_(Y)
+    torch.linalg.qr(Y_f, out=(Q_f, workspace[r]))
+    if Q is not Q_f:
+        Q.copy_(Q_f)
+    return Q
+
+def power_iterate(A, Q, workspace, n_iter):
+    """Refine the range basis ``Q`` of ``A`` with ``n_iter`` power iterations.
+
+    Each iteration multiplies by ``A^T`` and ``A`` again, re-orthonormalizing
+    after both products, which sharpens the spectral decay the sketch sees.
+    When the sketch is at least as wide as ``A`` it already spans the whole
+    range and ``Q`` is returned as is.
+    """
+    if "P" not in workspace:
+        return Q
+    for _ in range(n_iter):
+        Z = torch.matmul(A.mT, Q, out=workspace["Z"])
+        P = orthonormalize(Z, workspace, ("Z", "P", "R_P"))
+        Y = torch.matmul(A, P, out=workspace["Y"])
+        Q = orthonormalize(Y, workspace)
+    return Q
+
+def streaming_power_iterate(tiles, workspaces, n_iter):
+    """Range bases of several row-tiled matrices from the sketches in ``workspaces``.
+
+    ``tiles()`` yields ``(i, j, mats)`` with ``mats[k]`` the rows ``i:j`` of the
+    matrix sketched into ``workspaces[k]["Y"]``. Every power iteration makes two
+    passes over the tiles: one accumulating ``Z = A^T Q`` in float32 and one
+    writing ``Y = A P`` back tile by tile.
+    """
+    Qs = [orthonormalize(ws["Y"], ws) for ws in workspaces]
+    if n_iter == 0 or any("P" not in ws for ws in workspaces):
+        return Qs
+    for _ in range(n_iter):
+        Zs = [ws["Z_f"].zero_() for ws in workspaces]
+        for i, j, mats in tiles():
+            for A, Q, Z in zip(mats, Qs, Zs):
+                Z.addmm_(A.mT.float(), Q[i:j].float())
+        Ps = [orthonormalize(Z, ws, ("Z", "P", "R_P")) for Z, ws in zip(Zs, workspaces)]
+        for i, j, mats in tiles():
+            for A, P, ws in zip(mats, Ps, workspaces):
+                torch.matmul(A, P, out=ws["Y"][i:j])
+        Qs = [orthonormalize(ws["Y"], ws) for ws in workspaces]
+    return Qs
+
+def range_svd(Q, B, rank, workspace, out=None):
+    """Finish a randomized SVD from the range basis ``Q`` and ``B = Q^T A``.
+
+    The result is written into ``out = (U, S, V)`` when it is given.
+    """
+    datatype = Q.dtype
+    B_f, U_f, S_f, V_f, U_hat = (workspace[k] for k in ("B_f", "U_f", "S_f", "V_f", "U_hat"))
+    if B_f is not B:
+        B_f.copy_(B)
+    torch.linalg.svd(B_f, full_matrices=False, out=(U_f, S_f, V_f))
+    U_hat.copy_(U_f[..., :rank])
+    S, V = S_f[..., :rank], V_f[..., :rank, :]
+
+    if out is None:
+        return Q @ U_hat, S.to(datatype), V.to(datatype)
+    torch.matmul(Q, U_hat, out=out[0])
+    out[1].copy_(S)
+    out[2].copy_(V)
+    return out
+
+def randomized_svd(A, rank, init=None, oversample=0, out=None, workspace=None, n_iter=0, sketch=sketch_matrix):
+    """Rank-``rank`` randomized SVD of ``A``.
+
+    ``A`` may carry leading batch dimensions, in which case the sketch, QR and
+    small SVD all run as single batched calls over the stack of matrices.
+
+    ``init`` (``(..., n, k)``) warm-starts the range finder: its columns are
+    used as the first ``k`` columns of the test matrix, typically the previous
+    step's right factors. ``oversample`` extra Gaussian columns are appended
+    on top of ``rank`` and dropped again after the small SVD. ``n_iter`` power
+    iterations trade two more passes over ``A`` each for a more accurate basis.
+
+    ``workspace`` (see ``svd_workspace``) and ``out = (U, S, V)`` let callers
+    run the whole decomposition in preallocated buffers. ``init`` is consumed
+    before ``out`` is written, so it may alias ``out[2].mT``. ``sketch``
+    draws the test matrix, e.g. ``SketchProvider.for_key``.
+    """
+    m, n = A.shape[-2:]
+    if workspace is None:
+        workspace = svd_workspace(m, n, rank, oversample, A.shape[:-2], A.dtype, A.device, n_iter)
+    random_matrix = sketch(n, rank, init, oversample, out=workspace["omega"])
+    
+    Y = torch.matmul(A, random_matrix, out=workspace["Y"])
+    Q = power_iterate(A, orthonormalize(Y, workspace), workspace, n_iter)
+    B = torch.matmul(Q.mT, A, out=workspace["B"])
+
+    return range_svd(Q, B, rank, workspace, out)
+
+def reconstruct(U, S, V):
+    """Dense ``U @ diag(S) @ V``, also for stacks of factors."""
+    return (U * S.unsqueeze(-2)) @ V
+
+def shape_buckets(params, bucket_size, extra_key=None):
+    """Group ``params`` by (shape, dtype, device) into chunks of at most ``bucket_size``.
+
+    ``extra_key(p)`` further splits the groups, e.g. by the current state rank.
+    """
+    buckets = {}
+    for p in params:
+        key = (p.shape, p.dtype, p.device) + ((extra_key(p),) if extra_key is not None else ())
+        buckets.setdefault(key, []).append(p)
+    for bucket in buckets.values():
+        for i in range(0, len(bucket), bucket_size):
+            yield bucket[i:i + bucket_size]
+
+def factored_second_moment_(row, col, grad, beta2):
+    """Adafactor-style row/column second moment of ``grad``, updated in place.
+
+    ``row`` and ``col`` (float32, ``(..., m)`` and ``(..., n)``) track the EMA
+    of the row and column means of ``grad * grad``. Returns ``(r, c)`` such that
+    ``r[:, None] * c[None, :]`` is the square root of ``row x col / mean(row)``.
+    """
+    m, n = grad.shape[-2:]
+    # vector_norm only accumulates in a dtype at least as wide as grad's, so float64 grads stay float64
+    dtype = torch.promote_types(grad.dtype, torch.float32)
+    row.mul_(beta2).add_(torch.linalg.vector_norm(grad, dim=-1, dtype=dtype).square_(), alpha=(1-beta2) / n)
+    col.mul_(beta2).add_(torch.linalg.vector_norm(grad, dim=-2, dtype=dtype).square_(), alpha=(1-beta2) / m)
+    scale = row.mean(-1, keepdim=True).clamp_min_(torch.finfo(torch.float32).tiny)
+    return (row / scale).sqrt_(), col.sqrt()
+
+def quantize_blockwise_(x, q, absmax, block_size=256):
+    """Absmax int8 quantization of ``x`` into ``q``, in blocks of ``block_size`` elements.
+
+    The flattened tensor is split into blocks that each get their own float32
+    scale in ``absmax`` (``ceil(numel / block_size)`` entries); the last block
+    is zero-padded. ``q`` and ``absmax`` are written in place.
+    """
+    blocks = torch.zeros(absmax.numel() * block_size, dtype=torch.float32, device=x.device)
+    blocks[:x.numel()].copy_(x.reshape(-1))
+    blocks = blocks.view(-1, block_size)
+    torch.amax(blocks.abs(), dim=1, out=absmax)
+    blocks.div_(absmax.clamp_min(torch.finfo(torch.float32).tiny).unsqueeze(1)).mul_(127).round_()
+    q.view(-1).copy_(blocks.view(-1)[:q.numel()])
+    return q, absmax
+
+def dequantize_blockwise(q, absmax, block_size=256, dtype=torch.float32):
+    """Inverse of ``quantize_blockwise_``: a new ``dtype`` tensor shaped like ``q``."""
+    blocks = torch.zeros(absmax.numel() * block_size, dtype=torch.float32, device=q.device)
+    blocks[:q.numel()].copy_(q.reshape(-1))
+    blocks.view(-1, block_size).mul_(absmax.unsqueeze(1) / 127)
+    return blocks[:q.numel()].view(q.shape).to(dtype)
+
+def stacked_factors(states, keys, workspace):
+    """Stack per-parameter factors into buffers kept in a bucket ``workspace``."""
+    stacks = []
+    for k in keys:
+        tensors = [state[k] for state in states]
+        if k not in workspace:
+            workspace[k] = torch.empty((len(tensors), *tensors[0].shape), dtype=tensors[0].dtype, device=tensors[0].device)
+        stacks.append(torch.stack(tensors, out=workspace[k]))
+    return stacks
+
+def resize_rank(t, dim, rank):
+    """``t`` truncated or zero-padded to ``rank`` along ``dim``."""
+    if t.shape[dim] >= rank:
+        return t.narrow(dim, 0, rank).clone()
+    shape = list(t.shape)
+    shape[dim] = rank - t.shape[dim]
+    return torch.cat([t, t.new_zeros(shape)], dim=dim)
+
+class RankAllocator:
+    """Per-matrix ranks for the low-rank optimizers under a total state budget.
+
+    Every ``interval`` optimizer steps each matrix asks for the smallest rank
+    whose singular values hold ``energy`` of its observed spectral energy, or
+    one more than it observed when the whole spectrum is in use. While the
+    total optimizer state is above ``budget_bytes`` the rank slot with the
+    least normalised energy per byte is dropped, never going below
+    ``min_rank``. One allocator belongs to one optimizer.
+
+    Arguments:
+        budget_bytes (int): byte budget for all registered state.
+        min_rank (int): lower bound on every rank.
+        max_rank (int, optional): upper bound on every rank, also capped by
+            the smaller matrix side.
+        energy (float): fraction of observed spectral energy to keep.
+        interval (int): optimizer steps between rebalances.
+    """
+
+    def __init__(self, budget_bytes, min_rank=1, max_rank=None, energy=0.99, interval=100):
+        if not 0.0 < energy <= 1.0:
+            raise ValueError("Invalid energy: {} - should be in ]0.0, 1.0]".format(energy))
+        if interval < 1:
+            raise ValueError("Invalid interval: {} - should be >= 1".format(interval))
+        if min_rank < 1:
+            raise ValueError("Invalid min_rank: {} - should be >= 1".format(min_rank))
+        self.budget_bytes = budget_bytes
+        self.min_rank = min_rank
+        self.max_rank = max_rank
+        self.energy = energy
+        self.interval = interval
+        self.steps = 0
+        self.layers = {}
+
+    def register(self, key, rank, nbytes, max_rank=None):
+        """Track a matrix whose state costs ``nbytes(rank)`` bytes, e.g. its optimizer's ``_state_bytes``."""
+        caps = [r for r in (max_rank, self.max_rank) if r is not None]
+        self.layers[key] = dict(rank=rank, nbytes=nbytes, max_rank=min(caps) if caps else None, spectrum=None)
+
+    def rank(self, key):
+        return self.layers[key]["rank"]
+
+    @property
+    def due(self):
+        """Whether the current optimizer step ends with a rebalance, i.e. spectra should be observed."""
+        return (self.steps + 1) % self.interval == 0
+
+    def observe(self, key, S):
+        """Record the latest singular values of a matrix, largest first."""
+        self.layers[key]["spectrum"] = S.detach().float().cpu()
+
+    def state_bytes(self):
+        return sum(l["nbytes"](l["rank"]) for l in self.layers.values())
+
+    def tick(self, resize):
+        """Count one optimizer step; on rebalance call ``resize(key, rank)`` for every changed rank.
+
+        Returns whether any rank changed.
+        """
+        self.steps += 1
+        if self.steps % self.interval != 0:
+            return False
+        changed = False
+        for key, rank in self.rebalance().items():
+            if rank != self.layers[key]["rank"]:
+                self.layers[key]["rank"] = rank
+                resize(key, rank)
+                changed = True
+        return changed
+
+    def _clip(self, layer, rank):
+        rank = max(self.min_rank, rank)
+        return min(rank, layer["max_rank"]) if layer["max_rank"] is not None else rank
+
+    @staticmethod
+    def _slot_bytes(layer, rank):
+        # what dropping from rank to rank - 1 frees; not constant once absmax blocks or r x r Grams are counted
+        return layer["nbytes"](rank) - layer["nbytes"](rank - 1)
+
+    @staticmethod
+    def _slot_energy(layer, rank):
+        # normalised energy of the rank-th singular value; slots past the observed spectrum reuse its tail
+        S = layer["spectrum"]
+        energy = S.square()
+        return (energy[min(rank, len(S)) - 1] / energy.sum().clamp_min(1e-30)).item()
+
+    def rebalance(self):
+        """New rank for every registered matrix."""
+        ranks = {}
+        for key, layer in self.layers.items():
+            S = layer["spectrum"]
+            if S is None or len(S) == 0:
+                ranks[key] = layer["rank"]
+                continue
+            energy = S.square()
+            cumulative = energy.cumsum(0) / energy.sum().clamp_min(1e-30)
+            wanted = int((cumulative < self.energy).sum()) + 1
+            if wanted >= len(S):
+                wanted = len(S) + 1
+            ranks[key] = self._clip(layer, wanted)
+
+        used = sum(l["nbytes"](ranks[k]) for k, l in self.layers.items())
+        heap = [(self._slot_energy(l, ranks[k]) / self._slot_bytes(l, ranks[k]), i, k)
+                for i, (k, l) in enumerate(self.layers.items()) if l["spectrum"] is not None and ranks[k] > self.min_rank]
+        heapq.heapify(heap)
+        while used > self.budget_bytes and heap:
+            _, i, key = heapq.heappop(heap)
+            layer = self.layers[key]
+            used -= self._slot_bytes(layer, ranks[key])
+            ranks[key] -= 1
+            if ranks[key] > self.min_rank:
+                heapq.heappush(heap, (self._slot_energy(layer, ranks[key]) / self._slot_bytes(layer, ranks[key]), i, key))
+        return ranks
+
+def _dense_state(p, state, keys):
+    if len(state) == 0:
+        state["step"] = 0
+        for k in keys:
+            state[k] = torch.zeros_like(p.data)
+    state["step"] += 1
+    return state
+
+def dense_adamw_(params, grads, state, group):
+    """AdamW step for the non-matrix parameters of one group, fused with ``torch._foreach_*``."""
+    if not params:
+        return
+    beta1, beta2 = group["betas"]
+    states = [_dense_state(p, state[p], ("exp_avg", "exp_avg_sq")) for p in params]
+    exp_avgs = [s["exp_avg"] for s in states]
+    exp_avg_sqs = [s["exp_avg_sq"] for s in states]
+
+    torch._foreach_lerp_(exp_avgs, grads, 1.0 - beta1)
+    torch._foreach_mul_(exp_avg_sqs, beta2)
+    torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1.0 - beta2)
+    denom = torch._foreach_sqrt(exp_avg_sqs)
+    torch._foreach_add_(denom, group["eps"])
+
+    step_sizes = []
+    for s in states:
+        step_size = group["lr"]
+        if group.get("correct_bias", False):
+            step_size = step_size * math.sqrt(1.0 - beta2 ** s["step"]) / (1.0 - beta1 ** s["step"])
+        step_sizes.append(-step_size)
+
+    data = [p.data for p in params]
+    torch._foreach_addcdiv_(data, exp_avgs, denom, step_sizes)
+    if group["weight_decay"] > 0.0:
+        torch._foreach_add_(data, data, alpha=-group["lr"] * group["weight_decay"])
+
+def dense_lion_(params, grads, state, group):
+    """Lion step for the non-matrix parameters of one group, fused with ``torch._foreach_*``."""
+    if not params:
+        return
+    beta1, beta2 = group["betas"]
+    exp_avgs = [_dense_state(p, state[p], ("exp_avg",))["exp_avg"] for p in params]
+
+    update = torch._foreach_mul(exp_avgs, beta1)
+    torch._foreach_add_(update, grads, alpha=1.0 - beta1)
+    torch._foreach_sign_(update)
+    data = [p.data for p in params]
+    torch._foreach_add_(data, update, alpha=-group["lr"])
+
+    torch._foreach_lerp_(exp_avgs, grads, 1.0 - beta2)
+    if group["weight_decay"] > 0.0:
+        torch._foreach_add_(data, data, alpha=-group["lr"] * group["weight_decay"])
+
+def tensor_bytes(tensors):
+    """Bytes held by a tensor, or by the tensors in a (nested) dict, list or tuple; aliases count once."""
+    seen, total, stack = set(), 0, [tensors]
+    while stack:
+        t = stack.pop()
+        if isinstance(t, dict):
+            stack.extend(t.values())
+        elif isinstance(t, (list, tuple)):
+            stack.extend(t)
+        elif torch.is_tensor(t) and id(t) not in seen:
+            seen.add(id(t))
+            total += t.numel() * t.element_size()
+    return total
+
+def dense_state_bytes(p, moments=2):
+    """State of a dense optimizer keeping ``moments`` full-size moments of ``p``, e.g. 2 for AdamW."""
+    return moments * p.numel() * p.element_size()
+
+def optimizer_memory(optimizer, named_parameters=None):
+    """State and workspace bytes of one of the optimizers below, against dense AdamW.
+
+    Parameters that already have state are measured; for the rest, e.g.
+    before the first step, the optimizer predicts what its first step will
+    allocate at the parameter's current rank. Returns a dict with
+
+        params: {name: state bytes}, keyed by index without ``named_parameters``
+        groups: [state bytes per param group]
+        state: total state bytes
+        workspace: SVD workspaces, kept from one step to the next
+        temporaries: estimated dense temporaries of the largest matrix step, or
+            bucket step with ``foreach``, freed after it
+        dense_adamw: exp_avg + exp_avg_sq of torch.optim.AdamW on the same parameters
+        predicted: how many parameters were predicted rather than measured
+    """
+    names = {p: name for name, p in named_parameters} if named_parameters is not None else {}
+    allocator = getattr(optimizer, "rank_allocator", None)
+    params, groups, predicted, dense, temporaries = {}, [], 0, 0, 0
+    workspace_bytes = 0
+    foreach = getattr(optimizer, "foreach", False)
+    for group in optimizer.param_groups:
+        group_bytes = 0
+        # a foreach step stacks up to bucket_size same-shape matrices of a group, grads included
+        same_shape = collections.Counter((p.shape, p.dtype, p.device) for p in group["params"] if p.dim() == 2)
+        for p in group["params"]:
+            rank = allocator.rank(p) if allocator is not None and p in allocator.layers else optimizer.rank
+            state = optimizer.state.get(p)
+            if state:
+                nbytes = tensor_bytes(state)
+            else:
+                nbytes = optimizer._state_bytes(p, rank)
+                predicted += 1
+            params[names.get(p, len(params))] = nbytes
+            group_bytes += nbytes
+            dense += dense_state_bytes(p)
+            if p.dim() == 2:
+                # a tiled step only holds tile_size rows of each dense temporary
+                rows = min(p.shape[0], getattr(optimizer, "tile_size", None) or p.shape[0])
+                step_bytes = optimizer._step_temporaries * rows * p.shape[1] * p.element_size()
+                if foreach:
+                    bucket = min(optimizer.bucket_size, same_shape[(p.shape, p.dtype, p.device)])
+                    step_bytes = bucket * (optimizer._step_temporaries + 1) * p.numel() * p.element_size()
+                temporaries = max(temporaries, step_bytes)
+                if hasattr(optimizer, "_workspace_bytes"):
+                    workspace_bytes += optimizer._workspace_bytes(p, rank)
+        groups.append(group_bytes)
+    if getattr(optimizer, "_workspaces", None):
+        workspace_bytes = tensor_bytes(optimizer._workspaces)
+    return dict(params=params, groups=groups, state=sum(groups), workspace=workspace_bytes,
+                temporaries=temporaries, dense_adamw=dense, predicted=predicted)
+
+def step_pool(workers, intra_op_threads):
+    """Thread pool for per-parameter updates whose workers each run torch ops on ``intra_op_threads`` threads."""
+    return ThreadPoolExecutor(workers, thread_name_prefix="optim-step", initializer=torch.set_num_threads,
+                              initargs=(intra_op_threads,))
+
+def map_params(optimizer, fn, items):
+    """``fn(*item)`` for every ``(param, ...)`` item, on ``optimizer``'s thread pool if it has ``workers > 1``.
+
+    torch ops release the GIL, so the updates of independent parameters
+    overlap. The intra-op thread count is process-wide, so it is set to
+    ``intra_op_threads`` for the duration of the map and restored afterwards.
+    """
+    if optimizer.workers <= 1 or len(items) <= 1:
+        for item in items:
+            fn(*item)
+        return
+    if optimizer._pool is None:
+        optimizer._pool = step_pool(optimizer.workers, optimizer.intra_op_threads)
+    # largest matrices first, so the tail of the step is made of small ones
+    items = sorted(items, key=lambda item: -item[0].numel())
+    threads = torch.get_num_threads()
+    torch.set_num_threads(optimizer.intra_op_threads)
+    try:
+        # list() waits for every update and re-raises the first worker exception
+        list(optimizer._pool.map(lambda item: fn(*item), items))
+    finally:
+        torch.set_num_threads(threads)
+
+def _add_scaled_(param, update, scale):
+    # param += scale * update, for a float scale or a 0-d tensor one
+    if torch.is_tensor(scale):
+        return param.add_(update * scale)
+    return param.add_(update, alpha=scale)
+
+def _decay_(param, decay):
+    if torch.is_tensor(decay) or decay > 0.0:
+        _add_scaled_(param, param, -decay)
+
+def kernel_hparams(compiled, **hparams):
+    """Hyperparameter dict for the step kernels below.
+
+    In compiled mode the values are passed as 0-d float32 tensors, so a
+    compiled kernel is not specialised (and recompiled) on the step size and
+    learning rate, which change every step.
+    """
+    if compiled:
+        return {k: torch.tensor(v, dtype=torch.float32) for k, v in hparams.items()}
+    return hparams
+
+_compiled_kernels = {}
+
+def step_kernel(fn, compiled=False):
+    """``fn``, or its ``torch.compile``d version, shared by every optimizer instance."""
+    if not compiled:
+        return fn
+    kernel = _compiled_kernels.get(fn)
+    if kernel is None:
+        kernel = _compiled_kernels[fn] = torch.compile(fn)
+    return kernel
+
+def mlorc_adamw_step(param, grad, m_factors, sq_factors, hparams, nonneg=False):
+    """Elementwise part of an MLorc_AdamW2 step on one matrix.
+
+    Rebuilds both moments from their rank-r factors ``(u, s, v)``, folds in
+    ``grad``, and applies the AdamW update and weight decay to ``param`` in
+    place. ``hparams`` holds beta1, beta2, eps, step_size and decay
+    (lr * weight_decay). ``nonneg`` says the sq factors are non-negative (an
+    NMF), so the rebuilt second moment only needs its round-off clamped
+    instead of an ``abs``. Returns the new dense moments ``(m, sq)`` for the
+    caller to compress.
+    """
+    beta1, beta2 = hparams["beta1"], hparams["beta2"]
+    m = beta1 * reconstruct(*m_factors) + (1-beta1) * grad
+    sq = beta2 * reconstruct(*sq_factors) + (1-beta2) * grad * grad
+    # the rank-r SVD reconstruction of sq can dip below zero, hence abs as in MLorc_AdamW
+    denom = (sq.clamp(min=0) if nonneg else torch.abs(sq)).sqrt_().add_(hparams["eps"])
+    _add_scaled_(param, m / denom, -hparams["step_size"])
+    _decay_(param, hparams["decay"])
+    return m, sq
+
+def mlorc_adamw_factored_step(param, grad, m_factors, row, col, hparams):
+    """``mlorc_adamw_step`` with Adafactor row/column second moments, updated in place. Returns ``m``."""
+    beta1 = hparams["beta1"]
+    m = beta1 * reconstruct(*m_factors) + (1-beta1) * grad
+    r, c = factored_second_moment_(row, col, grad, hparams["beta2"])
+    denom = torch.outer(r, c).to(grad.dtype).add_(hparams["eps"])
+    _add_scaled_(param, m / denom, -hparams["step_size"])
+    _decay_(param, hparams["decay"])
+    return m
+
+def mlorc_lion_step(param, grad, m_factors, hparams):
+    """Elementwise part of an MLorc_Lion step on one matrix; returns the new momentum to compress."""
+    beta1, beta2 = hparams["beta1"], hparams["beta2"]
+    m = reconstruct(*m_factors)
+    update = (beta1 * m + (1-beta1) * grad).sign_()
+    _add_scaled_(param, update, -hparams["lr"])
+    _decay_(param, hparams["decay"])
+    return beta2 * m + (1-beta2) * grad
+
+def galore_step(param, grad, projector, exp_avg, exp_avg_sq, hparams):
+    """GaLore step on one (left-projected) matrix; ``exp_avg`` and ``exp_avg_sq`` are updated in place.
+
+    Weight decay is left to the caller, as ``param`` may be a transposed view.
+    """
+    beta1, beta2 = hparams["beta1"], hparams["beta2"]
+    R_ = projector.T @ grad
+    exp_avg.mul_(beta1).add_(R_, alpha=1.0 - beta1)
+    exp_avg_sq.mul_(beta2).addcmul_(R_, R_, value=1.0 - beta2)
+    denom = exp_avg_sq.sqrt().add_(hparams["eps"])
+    _add_scaled_(param, projector @ torch.div(exp_avg, denom), -hparams["step_size"])
+
+def mlorc_adamw_ab_step(param, grad, m_factors, sq_factors, hparams):
+    """Elementwise part of an MLorc_AdamW step with ``A @ B`` factored moments; returns ``(m, sq)``."""
+    beta1, beta2 = hparams["beta1"], hparams["beta2"]
+    m = beta1 * m_factors[0] @ m_factors[1] + (1-beta1) * grad
+    sq = beta2 * sq_factors[0] @ sq_factors[1] + (1-beta2) * grad * grad
+    denom = torch.abs(sq).sqrt().add_(hparams["eps"])
+    _add_scaled_(param, m / denom, -hparams["step_size"])
+    _decay_(param, hparams["decay"])
+    return m, sq
+
+class _LowRankOptimizer(Optimizer):
+    """Options and helpers shared by the low-rank optimizers below.
+
+    Subclasses validate and store their own options, then pass the shared
+    ones on to this constructor. They provide ``_init_state``,
+    ``_state_bytes``, ``_resize_rank`` and ``_step_param``, which updates one
+    matrix without touching any other parameter's state, so that it may run
+    on a worker thread. The SVD workspace helpers are for the ones that
+    compress a moment with ``randomized_svd`` every step.
+    """
+    # whether a step releases every p.grad as soon as it has been read
+    _frees_grads = False
+    # methods profiling.StepProfiler times, by phase; subclasses extend it with their own
+    _profile_phases = {"_step_group": "step_group", "_step_param": "step_param", "_init_state": "init_state",
+                       "_finish_step": "finish"}
+
+    def __init__(self, params, defaults, rank, dense_fallback=False, rank_allocator=None, oversample=0, n_iter=0,
+                 compiled=False, workers=0, intra_op_threads=None, sketch_seed=None, sketch_refresh=1):
+        if workers < 0:
+            raise ValueError("Invalid workers: {} - should be >= 0".format(workers))
+        if intra_op_threads is not None and intra_op_threads < 1:
+            raise ValueError("Invalid intra_op_threads: {} - should be >= 1".format(intra_op_threads))
+        if oversample < 0:
+            raise ValueError("Invalid oversample: {} - should be >= 0".format(oversample))
+        if n_iter < 0:
+            raise ValueError("Invalid n_iter: {} - should be >= 0".format(n_iter))
         self.rank=rank
+        # dense_fallback: train non-matrix parameters (norms, biases) with the fused foreach step of the
+        # matching dense optimizer, dense_adamw_ or dense_lion_
+        self.dense_fallback=dense_fallback
+        # rank_allocator: optional RankAllocator that resizes each matrix's rank under a state budget
+        self.rank_allocator=rank_allocator
+        # oversample / n_iter: extra random columns and power iterations of the randomized range finder,
+        # each power iteration two more passes over the matrix
+        self.oversample=oversample
+        self.n_iter=n_iter
+        # compiled: run the per-matrix step kernel through torch.compile
+        self.compiled=compiled
+        # workers: update up to this many matrices at once on a thread pool, each with intra_op_threads
+        # torch threads (by default an even share of the current ones); 0 or 1 steps them one by one
+        self.workers=workers
+        self.intra_op_threads=intra_op_threads or max(1, torch.get_num_threads() // max(1, workers))
+        self._pool=None
+        # preallocated SVD buffers per parameter (or per foreach bucket) and moment, reused every step
+        self._workspaces = {}
         super().__init__(params, defaults)
-
-
-
-    def step(self, closure=None):
-        """Performs a single optimization step.
-        Arguments:
-            closure (callable, optional): A closure that reevaluates the model
-                and returns the loss.
+        # sketch_seed / sketch_refresh: per-matrix seeded test matrices of the range finder, redrawn every
+        # sketch_refresh steps
+        self.sketches = SketchProvider([p for group in self.param_groups for p in group["params"]],
+                                       sketch_seed, sketch_refresh)
+
+    def _register_rank(self, p, rank):
+        """Track ``p`` at ``rank`` in the rank allocator, if there is one."""
+        if self.rank_allocator is not None:
+            self.rank_allocator.register(p, rank, functools.partial(self._state_bytes, p), max_rank=min(p.shape))
+
+    def memory_report(self, named_parameters=None):
+        """State, workspace and temporary bytes against dense AdamW, see ``optimizer_memory``."""
+        return optimizer_memory(self, named_parameters)
+
+    def _workspace(self, key, A, rank):
+        """SVD workspace for ``A`` (one matrix or a stack), allocated on first use."""
+        workspace = self._workspaces.get(key)
+        if workspace is None:
+            workspace = self._workspaces[key] = svd_workspace(*A.shape[-2:], rank, self.oversample,
+                                                              A.shape[:-2], A.dtype, A.device, self.n_iter)
+            workspace["sketch"] = self.sketches.for_key(key)
+        return workspace
+
+    def _compress(self, A, factors, step, workspace):
+        """Randomized SVD of the new moment ``A`` into ``factors = (u, s, v)``, in place."""
+        rank = factors[1].shape[-1]
+        init = factors[2].mT if self.warm_start and step > 1 else None
+        return randomized_svd(A, rank, init, self.oversample, out=factors, workspace=workspace, n_iter=self.n_iter,
+                              sketch=workspace["sketch"])
+
+    def _sketch(self, v, step, workspace):
+        """Test matrix used by ``_compress``, for the streaming tiled path."""
+        init = v.mT if self.warm_start and step > 1 else None
+        return workspace["sketch"](v.shape[-1], v.shape[-2], init, self.oversample, out=workspace["omega"])
+
+    def _observe(self, p, workspace, index=None):
+        """Hand the full sketched spectrum of the first moment to the rank allocator when it is due."""
+        if self.rank_allocator is not None and self.rank_allocator.due:
+            S = workspace["S_f"]
+            self.rank_allocator.observe(p, S if index is None else S[index])
+
+    def _matrix_grads(self, group):
+        """Split ``group``'s gradients into ``(matrices, dense_params, dense_grads)``.
+
+        ``matrices`` holds ``(p, grad)`` for every 2-D parameter, after its
+        state (and rank allocator registration) has been created; that happens
+        here, in parameter order, before any worker runs. Other parameters
+        are only kept with ``dense_fallback``.
         """
-        loss = None
-        if closure is not None:
-            loss = closure()
-
-        for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
+        matrices, dense_params, dense_grads = [], [], []
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+            grad = p.grad.data
+            if self._frees_grads:
                 p.grad = None
 
-                if grad.dim() != 2:
-                    continue
-                if grad.is_sparse:
-                    raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
-                    
-                state = self.state[p]
-                # State initialization
-                if len(state) == 0:
-                    state["step"] = 0
-                    # Exponential moving average of gradient values
-                    state["m_u"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
-                    state["m_v"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
-                    state["m_s"] = torch.zeros((self.rank), dtype=p.data.dtype, device=p.data.device)
-                    # Exponential moving average of squared gradient values
-                    state["sq_u"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
-                    state["sq_v"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
-                    state["sq_s"] = torch.zeros((self.rank), dtype=p.data.dtype, device=p.data.device)
-
-                m_u, m_v, m_s, sq_u, sq_v, sq_s = state["m_u"], state["m_v"], state["m_s"], state["sq_u"], state["sq_v"], state["sq_s"]
-
-                beta1, beta2 = group["betas"]
-
-                state["step"] += 1
-
-                m=beta1 * m_u @ torch.diag(m_s) @ m_v + (1-beta1) * grad
-                sq=beta2 * sq_u @ torch.diag(sq_s) @ sq_v + (1-beta2) * grad * grad
-
-                m_u, m_s, m_v = randomized_svd(m, self.rank)
-                sq_u, sq_s, sq_v = randomized_svd(sq, self.rank)
-
-                # Decay the first and second moment running average coefficient
-                # In-place operations to update the averages at the same time
-                denom = sq.sqrt().add_(group["eps"])
-
-                step_size = group["lr"]
-                if 'correct_bias' in group and group["correct_bias"]:  # No bias correction for Bert
-                    bias_correction1 = 1.0 - beta1 ** state["step"]
-                    bias_correction2 = 1.0 - beta2 ** state["step"]
-                    step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
-
-                p.data.addcdiv_(-step_size, m, denom)
-
-                # Just adding the square of the weights to the loss function is *not*
-                # the correct way of using L2 regularization/weight decay with Adam,
-                # since that will interact with the m and v parameters in strange ways.
-                #
-                # Instead we want to decay the weights in a manner that doesn't interact
-                # with the m/v parameters. This is equivalent to adding the square
-                # of the weights to the loss with plain (non-momentum) SGD.
-                # Add weight decay at the end (fixed version)
-                if group["weight_decay"] > 0.0:
-                    p.data.add_(p.data, alpha=-group["lr"] * group["weight_decay"])
-
-        return loss
-
-
-class MLorc_Lion(Optimizer):
-    def __init__(self, params, lr=1e-3, betas=(0.95, 0.98), weight_decay=0.05,  rank=4):
-        defaults = dict(lr=lr, betas=betas, weight_decay=weight_decay)
-        self.rank=rank
-        super().__init__(params, defaults)
-
-
+            if grad.dim() != 2:
+                if self.dense_fallback:
+                    dense_params.append(p)
+                    dense_grads.append(grad)
+                continue
+            if grad.is_sparse:
+                raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
+            self._init_state(p)
+            matrices.append((p, grad))
+        return matrices, dense_params, dense_grads
+
+    def _dense_step(self, params, grads, group):
+        """Fused dense step of the non-matrix parameters; AdamW unless a subclass trains them otherwise."""
+        dense_adamw_(params, grads, self.state, group)
+
+    def _step_group(self, group):
+        """Update the parameters of one param group, or of a single-parameter view of one."""
+        matrices, dense_params, dense_grads = self._matrix_grads(group)
+        map_params(self, lambda p, grad: self._step_param(p, grad, group), matrices)
+        self._dense_step(dense_params, dense_grads, group)
+
+    def _rebalance_ranks(self):
+        if self.rank_allocator is not None and self.rank_allocator.tick(self._resize_rank):
+            self._workspaces.clear()
+
+    def _step_size(self, group, step):
+        beta1, beta2 = group["betas"]
+        step_size = group["lr"]
+        if 'correct_bias' in group and group["correct_bias"]:  # No bias correction for Bert
+            bias_correction1 = 1.0 - beta1 ** step
+            bias_correction2 = 1.0 - beta2 ** step
+            step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
+        return step_size
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -153,124 +851,731 @@ class MLorc_Lion(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-
-                if grad.dim() != 2:
-                    continue
-                if grad.is_sparse:
-                    raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
-                    
-                state = self.state[p]
-                # State initialization
-                if len(state) == 0:
-                    state["step"] = 0
-                    # Exponential moving average of gradient values
-
-                    state["m_u"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
-                    state["m_v"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
-                    state["m_s"] = torch.zeros((self.rank), dtype=p.data.dtype, device=p.data.device)
-
-                m_u, m_v, m_s= state["m_u"], state["m_v"], state["m_s"]
-                beta1, beta2 = group["betas"]
-
-                m=m_u @ torch.diag(m_s) @ m_v
-                update=(beta1 * m + (1-beta1) * grad).sign_()
-
-                state["step"] += 1
-                step_size = group["lr"]
-                p.data.add_(update, alpha=-step_size)
-
-                m_=beta2 * m + (1-beta2) * grad
-                m_u, m_s, m_v = randomized_svd(m_, self.rank)
-
-                if group["weight_decay"] > 0.0:
-                    p.data.add_(p.data, alpha=-group["lr"] * group["weight_decay"])
+            self._step_group(group)
 
+        self._finish_step()
         return loss
 
-
-class GaLore(Optimizer):
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01, correct_bias=True, rank=4, T=100):
+    def _finish_step(self):
+        """Once-per-step work that runs after every parameter has been updated."""
+        self._rebalance_ranks()
+
+class MLorc_AdamW2(_LowRankOptimizer):
+    _profile_phases = dict(_LowRankOptimizer._profile_phases, _workspace="workspace", _dequantize_factors="dequantize",
+                           _quantize_factors="quantize", _compress="compress", _compress_nonneg="nmf",
+                           _observe="rank_observe", _step_tiled="tiled", _step_foreach="foreach")
+    # dense m x n matrices a per-matrix step holds at once: m, sq, denom and the update
+    _step_temporaries = 4
+    _frees_grads = True
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01, correct_bias=True, rank=4,
+                 foreach=False, bucket_size=8, warm_start=False, oversample=0, tile_size=None,
+                 dense_fallback=False, second_moment="svd", rank_allocator=None, n_iter=0,
+                 quantize_factors=False, quant_block_size=256, compiled=False, workers=0, intra_op_threads=None,
+                 nmf_iter=2, nmf_method="als", sketch_seed=None, sketch_refresh=1):
+        if lr < 0.0:
+            raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
+        if not 0.0 <= betas[0] < 1.0:
+            raise ValueError("Invalid beta parameter: {} - should be in [0.0, 1.0[".format(betas[0]))
+        if not 0.0 <= betas[1] < 1.0:
+            raise ValueError("Invalid beta parameter: {} - should be in [0.0, 1.0[".format(betas[1]))
+        if not 0.0 <= eps:
+            raise ValueError("Invalid epsilon value: {} - should be >= 0.0".format(eps))
+        if bucket_size < 1:
+            raise ValueError("Invalid bucket size: {} - should be >= 1".format(bucket_size))
+        if warm_start and oversample < 1:
+            raise ValueError("Invalid oversample: {} - warm_start needs >= 1 random column".format(oversample))
+        if tile_size is not None and tile_size < 1:
+            raise ValueError("Invalid tile size: {} - should be >= 1".format(tile_size))
+        if tile_size is not None and foreach:
+            raise ValueError("tile_size and foreach are mutually exclusive")
+        if second_moment not in ("svd", "factored", "nmf"):
+            raise ValueError("Invalid second_moment: {} - should be 'svd', 'factored' or 'nmf'".format(second_moment))
+        if second_moment == "nmf" and tile_size is not None:
+            raise ValueError("second_moment='nmf' does not support tile_size")
+        if nmf_iter < 1:
+            raise ValueError("Invalid nmf_iter: {} - should be >= 1".format(nmf_iter))
+        if nmf_method not in ("als", "mu"):
+            raise ValueError("Invalid nmf_method: {} - should be 'als' or 'mu'".format(nmf_method))
+        if quant_block_size < 1:
+            raise ValueError("Invalid quant_block_size: {} - should be >= 1".format(quant_block_size))
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias)
-        self.rank=rank
-        self.T=T
-        super().__init__(params, defaults)
-
-
-
-    def step(self, closure=None):
-        """Performs a single optimization step.
-        Arguments:
-            closure (callable, optional): A closure that reevaluates the model
-                and returns the loss.
+        # foreach: stack same-shape matrices and compress them with one batched randomized SVD
+        self.foreach=foreach
+        self.bucket_size=bucket_size
+        # warm_start: seed the range finder with last step's right factors plus `oversample` random columns
+        self.warm_start=warm_start
+        # tile_size: rows per tile of the fused update, bounds the dense temporaries to tile_size x n
+        self.tile_size=tile_size
+        # second_moment: "svd" keeps rank-r sq_u/sq_s/sq_v, "factored" keeps Adafactor row/column accumulators,
+        # "nmf" keeps non-negative sq_u/sq_s/sq_v refined by nmf_iter warm-started nmf_method iterations per step
+        self.second_moment=second_moment
+        self.nmf_iter=nmf_iter
+        self.nmf_method=nmf_method
+        # quantize_factors: keep the u/v factors as blockwise int8 (m_u_q, m_u_absmax, ...) between steps,
+        # dequantized to the parameter dtype only while the step runs
+        self.quantize_factors=quantize_factors
+        self.quant_block_size=quant_block_size
+        super().__init__(params, defaults, rank, dense_fallback, rank_allocator, oversample, n_iter,
+                         compiled, workers, intra_op_threads, sketch_seed, sketch_refresh)
+
+    def _init_state(self, p):
+        state = self.state[p]
+        if len(state) == 0:
+            if self.rank > min(p.shape):
+                raise ValueError("Invalid rank: {} - exceeds matrix shape {}".format(self.rank, tuple(p.shape)))
+            self._register_rank(p, self.rank)
+            state["step"] = 0
+            # Exponential moving average of gradient values
+            state["m_u"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
+            state["m_v"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
+            state["m_s"] = torch.zeros((self.rank), dtype=p.data.dtype, device=p.data.device)
+            # Exponential moving average of squared gradient values
+            if self.second_moment == "factored":
+                state["sq_row"] = torch.zeros((p.data.shape[0]), dtype=torch.float32, device=p.data.device)
+                state["sq_col"] = torch.zeros((p.data.shape[1]), dtype=torch.float32, device=p.data.device)
+            else:
+                state["sq_u"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
+                state["sq_v"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
+                state["sq_s"] = torch.zeros((self.rank), dtype=p.data.dtype, device=p.data.device)
+            self._quantize_factors(state)
+        return state
+
+    def _state_bytes(self, p, rank):
+        """Bytes ``_init_state`` will allocate for ``p`` at ``rank``."""
+        if p.dim() != 2:
+            return dense_state_bytes(p) if self.dense_fallback else 0
+        m, n = p.shape
+        if self.quantize_factors:
+            factor = sum(k + 4 * -(-k // self.quant_block_size) for k in (m * rank, rank * n))
+        else:
+            factor = (m + n) * rank * p.element_size()
+        moment = factor + rank * p.element_size()
+        if self.second_moment == "factored":
+            return moment + 4 * (m + n)
+        return 2 * moment
+
+    def _workspace_bytes(self, p, rank):
+        """Bytes of the SVD workspaces ``_workspace`` will allocate for ``p`` at ``rank``."""
+        factored = self.second_moment == "factored"
+        workspace = svd_workspace(*p.shape, rank, self.oversample, dtype=p.dtype, device="meta", n_iter=self.n_iter)
+        nbytes = tensor_bytes(workspace) * (2 if self.second_moment == "svd" else 1)
+        if self.foreach:
+            # buckets also stack the (dequantized) factors of their members in the workspace
+            nbytes += (1 if factored else 2) * (sum(p.shape) + 1) * rank * p.element_size()
+            nbytes += 4 * sum(p.shape) if factored else 0
+        return nbytes
+
+    def _quantize_factors(self, state):
+        """Move the dense u/v factors of ``state`` into their int8 storage."""
+        if not self.quantize_factors:
+            return
+        for k in ("m_u", "m_v", "sq_u", "sq_v"):
+            if k not in state:
+                continue
+            x = state.pop(k)
+            q = state.get(k + "_q")
+            if q is None or q.shape != x.shape:
+                q = state[k + "_q"] = torch.empty(x.shape, dtype=torch.int8, device=x.device)
+                state[k + "_absmax"] = torch.empty(-(-x.numel() // self.quant_block_size), dtype=torch.float32, device=x.device)
+            quantize_blockwise_(x, q, state[k + "_absmax"], self.quant_block_size)
+
+    def _dequantize_factors(self, state):
+        """Dense u/v factors for one step, in the dtype of the singular values."""
+        if not self.quantize_factors:
+            return
+        for k in ("m_u", "m_v", "sq_u", "sq_v"):
+            if k + "_q" in state:
+                state[k] = dequantize_blockwise(state[k + "_q"], state[k + "_absmax"], self.quant_block_size, state["m_s"].dtype)
+
+    def _compress_nonneg(self, A, factors, step, key):
+        """Non-negative factorization of the new second moment ``A`` into ``factors``, in place.
+
+        Warm-started from the previous step's factors; the first step seeds
+        them from a randomized SVD instead, as the zero state has no support.
         """
-        loss = None
-        if closure is not None:
-            loss = closure()
-
-        for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-
-                if grad.dim() != 2:
-                    continue
-                if grad.is_sparse:
-                    raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
-
-
-                state = self.state[p]
-
-                # State initialization
-                if len(state) == 0:
-                    state["step"] = 0
-                    # Exponential moving average of gradient values
-                    state["exp_avg"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
-                    state["exp_avg_sq"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
-                    state["projector"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
-
-                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
-                beta1, beta2 = group["betas"]
-
+        rank = factors[1].shape[-1]
+        if step == 1:
+            init = randomized_svd(A, rank, oversample=self.oversample, n_iter=self.n_iter, sketch=self.sketches.for_key(key))
+        else:
+            init = factors
+        for f, new in zip(factors, nmf(A, *init, rank, self.nmf_iter, method=self.nmf_method)):
+            f.copy_(new)
+
+    def _resize_rank(self, p, rank):
+        state = self.state[p]
+        self._dequantize_factors(state)
+        for prefix in ("m_", "sq_"):
+            if prefix + "u" in state:
+                state[prefix + "u"] = resize_rank(state[prefix + "u"], 1, rank)
+                state[prefix + "s"] = resize_rank(state[prefix + "s"], 0, rank)
+                state[prefix + "v"] = resize_rank(state[prefix + "v"], 0, rank)
+        self._quantize_factors(state)
+
+    def _step_group(self, group):
+        if self.foreach:
+            self._step_foreach(group)
+            return
+        super()._step_group(group)
+
+    def _step_param(self, p, grad, group):
+        state = self.state[p]
+        self._dequantize_factors(state)
+        if self.tile_size is not None:
+            self._step_tiled(p, grad, state, group)
+            self._quantize_factors(state)
+            return
+
+        m_factors = (state["m_u"], state["m_s"], state["m_v"])
+        beta1, beta2 = group["betas"]
+
+        state["step"] += 1
+        # Just adding the square of the weights to the loss function is *not*
+        # the correct way of using L2 regularization/weight decay with Adam,
+        # since that will interact with the m and v parameters in strange ways.
+        # The kernels decay the weights directly instead, after the update.
+        hparams = kernel_hparams(self.compiled, beta1=beta1, beta2=beta2, eps=group["eps"],
+                                 step_size=self._step_size(group, state["step"]),
+                                 decay=group["lr"] * group["weight_decay"])
+
+        m_ws = self._workspace((p, "m"), grad, m_factors[1].shape[0])
+        if self.second_moment == "factored":
+            kernel = step_kernel(mlorc_adamw_factored_step, self.compiled)
+            m = kernel(p.data, grad, m_factors, state["sq_row"], state["sq_col"], hparams)
+            self._compress(m, m_factors, state["step"], m_ws)
+        else:
+            sq_factors = (state["sq_u"], state["sq_s"], state["sq_v"])
+            nonneg = self.second_moment == "nmf"
+            m, sq = step_kernel(mlorc_adamw_step, self.compiled)(p.data, grad, m_factors, sq_factors, hparams, nonneg)
+            self._compress(m, m_factors, state["step"], m_ws)
+            if nonneg:
+                self._compress_nonneg(sq, sq_factors, state["step"], (p, "sq"))
+            else:
+                self._compress(sq, sq_factors, state["step"], self._workspace((p, "sq"), grad, sq_factors[1].shape[0]))
+        self._observe(p, m_ws)
+        self._quantize_factors(state)
+
+    def _step_tiled(self, p, grad, state, group):
+        """Row-tiled version of the per-tensor update.
+
+        Both moments, the denominator, the parameter update and weight decay
+        are formed ``tile_size`` rows at a time in one pass, while the sketches
+        ``Y = M @ Omega`` are accumulated tile by tile. A second pass rebuilds
+        the tiles to accumulate ``B = Q^T M``, so the extra memory is a few
+        ``tile_size x n`` tiles plus the rank-sized sketches.
+        """
+        m_u, m_v, m_s = state["m_u"], state["m_v"], state["m_s"]
+        factored = self.second_moment == "factored"
+        if not factored:
+            sq_u, sq_v, sq_s = state["sq_u"], state["sq_v"], state["sq_s"]
+        beta1, beta2 = group["betas"]
+        rows = grad.shape[0]
+        decay = group["lr"] * group["weight_decay"]
+
+        state["step"] += 1
+        step_size = self._step_size(group, state["step"])
+
+        def moments(i, j):
+            g = grad[i:j]
+            m = torch.addmm(g, m_u[i:j] * m_s, m_v, beta=1-beta1, alpha=beta1)
+            if factored:
+                return m, None
+            sq = torch.addmm(g * g, sq_u[i:j] * sq_s, sq_v, beta=1-beta2, alpha=beta2)
+            return m, sq
+
+        m_ws = self._workspace((p, "m"), grad, m_s.shape[0])
+        m_omega = self._sketch(m_v, state["step"], m_ws)
+        m_Y = m_ws["Y"]
+        if factored:
+            # the row/column accumulators only need reductions over the full gradient
+            r, c = factored_second_moment_(state["sq_row"], state["sq_col"], grad, beta2)
+        else:
+            sq_ws = self._workspace((p, "sq"), grad, sq_s.shape[0])
+            sq_omega = self._sketch(sq_v, state["step"], sq_ws)
+            sq_Y = sq_ws["Y"]
+        for i in range(0, rows, self.tile_size):
+            j = min(i + self.tile_size, rows)
+            m, sq = moments(i, j)
+            torch.matmul(m, m_omega, out=m_Y[i:j])
+            if factored:
+                denom = torch.outer(r[i:j], c).to(grad.dtype).add_(group["eps"])
+            else:
+                torch.matmul(sq, sq_omega, out=sq_Y[i:j])
+                denom = sq.abs_().sqrt_().add_(group["eps"])
+
+            p_tile = p.data[i:j]
+            p_tile.addcdiv_(m, denom, value=-step_size)
+            if group["weight_decay"] > 0.0:
+                p_tile.add_(p_tile, alpha=-decay)
+
+        def tiles():
+            for i in range(0, rows, self.tile_size):
+                j = min(i + self.tile_size, rows)
+                yield (i, j, moments(i, j)[:1 if factored else 2])
+
+        Qs = streaming_power_iterate(tiles, [m_ws] if factored else [m_ws, sq_ws], self.n_iter)
+        # B = Q^T M is accumulated in float32 across tiles
+        m_Q, m_B = Qs[0], m_ws["B_f"].zero_()
+        if not factored:
+            sq_Q, sq_B = Qs[1], sq_ws["B_f"].zero_()
+        for i, j, (m, *sq) in tiles():
+            m_B.addmm_(m_Q[i:j].mT.float(), m.float())
+            if not factored:
+                sq_B.addmm_(sq_Q[i:j].mT.float(), sq[0].float())
+
+        range_svd(m_Q, m_B, m_s.shape[0], m_ws, out=(m_u, m_s, m_v))
+        if not factored:
+            range_svd(sq_Q, sq_B, sq_s.shape[0], sq_ws, out=(sq_u, sq_s, sq_v))
+        self._observe(p, m_ws)
+
+    def _step_foreach(self, group):
+        """Multi-tensor version of ``step`` for one param group.
+
+        Matrices are bucketed by shape so that reconstruction, the randomized
+        SVD of both moments and the parameter update each run once per bucket
+        instead of once per parameter.
+        """
+        matrices, dense_params, dense_grads = self._matrix_grads(group)
+        grads = dict(matrices)
+
+        beta1, beta2 = group["betas"]
+        for bucket in shape_buckets(list(grads), self.bucket_size, lambda p: self.state[p]["m_s"].shape[0]):
+            states = [self.state[p] for p in bucket]
+            for state in states:
+                self._dequantize_factors(state)
+            grad = torch.stack([grads[p] for p in bucket])
+            rank = states[0]["m_s"].shape[0]
+            m_ws = self._workspace((tuple(bucket), "m"), grad, rank)
+            m_u, m_s, m_v = stacked_factors(states, ("m_u", "m_s", "m_v"), m_ws)
+            m = beta1 * reconstruct(m_u, m_s, m_v) + (1-beta1) * grad
+            moments = [(("m_u", "m_s", "m_v"), m, (m_u, m_s, m_v), m_ws)]
+            if self.second_moment == "factored":
+                row, col = stacked_factors(states, ("sq_row", "sq_col"), m_ws)
+                r, c = factored_second_moment_(row, col, grad, beta2)
+                torch._foreach_copy_([state["sq_row"] for state in states], row.unbind(0))
+                torch._foreach_copy_([state["sq_col"] for state in states], col.unbind(0))
+                denom = (r.unsqueeze(-1) * c.unsqueeze(-2)).to(grad.dtype).add_(group["eps"])
+            else:
+                # nmf needs no SVD workspace, only somewhere to keep the stacked factors
+                sq_ws = (self._workspace((tuple(bucket), "sq"), grad, rank) if self.second_moment == "svd"
+                         else self._workspaces.setdefault((tuple(bucket), "sq"), {}))
+                sq_u, sq_s, sq_v = stacked_factors(states, ("sq_u", "sq_s", "sq_v"), sq_ws)
+                sq = beta2 * reconstruct(sq_u, sq_s, sq_v) + (1-beta2) * grad * grad
+                moments.append((("sq_u", "sq_s", "sq_v"), sq, (sq_u, sq_s, sq_v), sq_ws))
+
+            step_sizes = []
+            for state in states:
                 state["step"] += 1
+                step_sizes.append(-self._step_size(group, state["step"]))
 
-                if(state["step"]%self.T==1):
-
-                    u, s, v=torch.linalg.svd(grad.float(), full_matrices=False)
-                    state["projector"] = u[:, :self.rank].bfloat16()
-
-                Projector = state["projector"]
-                R_=Projector.T @ grad
-
-                # Decay the first and second moment running average coefficient
-                # In-place operations to update the averages at the same time
-                exp_avg.mul_(beta1).add_(R_, alpha=1.0 - beta1)
-                exp_avg_sq.mul_(beta2).addcmul_(R_, R_, value=1.0 - beta2)
-                denom = exp_avg_sq.sqrt().add_(group["eps"])
-
-                step_size = group["lr"]
-                if 'correct_bias' in group and group["correct_bias"]:  # No bias correction for Bert
-                    bias_correction1 = 1.0 - beta1 ** state["step"]
-                    bias_correction2 = 1.0 - beta2 ** state["step"]
-                    step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
-
-                grad_d=torch.div(exp_avg, denom)
-                u_grad_d= -step_size * Projector @ grad_d
-
-                p.data.add_(u_grad_d)
-
-
-                if group["weight_decay"] > 0.0:
-                    p.data.add_(p.data, alpha=-group["lr"] * group["weight_decay"])
-
-        return loss
+            # warm-start the whole bucket only once every member has real factors
+            step = min(state["step"] for state in states)
+            for keys, A, factors, workspace in moments:
+                if keys[0] == "sq_u" and self.second_moment == "nmf":
+                    self._compress_nonneg(A, factors, step, (tuple(bucket), "sq"))
+                else:
+                    self._compress(A, factors, step, workspace)
+                for k, f in zip(keys, factors):
+                    torch._foreach_copy_([state[k] for state in states], f.unbind(0))
+            for i, p in enumerate(bucket):
+                self._observe(p, m_ws, i)
+            for state in states:
+                self._quantize_factors(state)
+
+            # as in mlorc_adamw_step: the rank-r SVD reconstruction of sq can dip below zero
+            if self.second_moment == "svd":
+                denom = sq.abs_().sqrt_().add_(group["eps"])
+            elif self.second_moment == "nmf":
+                denom = sq.clamp_(min=0).sqrt_().add_(group["eps"])
+
+            data = [p.data for p in bucket]
+            torch._foreach_addcdiv_(data, m.unbind(0), denom.unbind(0), step_sizes)
+            if group["weight_decay"] > 0.0:
+                torch._foreach_add_(data, data, alpha=-group["lr"] * group["weight_decay"])
+
+        self._dense_step(dense_params, dense_grads, group)
+
+
+class MLorc_Lion(_LowRankOptimizer):
+    _profile_phases = dict(_LowRankOptimizer._profile_phases, _workspace="workspace", _compress="compress",
+                           _observe="rank_observe", _step_tiled="tiled", _step_foreach="foreach")
+    # dense m x n matrices a per-matrix step holds at once: m, the signed update and the new momentum
+    _step_temporaries = 3
+
+    def __init__(self, params, lr=1e-3, betas=(0.95, 0.98), weight_decay=0.05,  rank=4, foreach=False, bucket_size=8,
+                 warm_start=False, oversample=0, dense_fallback=False, rank_allocator=None, n_iter=0, compiled=False,
+                 workers=0, intra_op_threads=None, tile_size=None, sketch_seed=None, sketch_refresh=1):
+        if bucket_size < 1:
+            raise ValueError("Invalid bucket size: {} - should be >= 1".format(bucket_size))
+        if warm_start and oversample < 1:
+            raise ValueError("Invalid oversample: {} - warm_start needs >= 1 random column".format(oversample))
+        if tile_size is not None and tile_size < 1:
+            raise ValueError("Invalid tile size: {} - should be >= 1".format(tile_size))
+        if tile_size is not None and foreach:
+            raise ValueError("tile_size and foreach are mutually exclusive")
+        defaults = dict(lr=lr, betas=betas, weight_decay=weight_decay)
+        # foreach: stack same-shape matrices and compress them with one batched randomized SVD
+        self.foreach=foreach
+        self.bucket_size=bucket_size
+        # tile_size: rows per tile of the fused sign update, bounds the dense temporaries to tile_size x n
+        self.tile_size=tile_size
+        # warm_start: seed the range finder with last step's right factors plus `oversample` random columns
+        self.warm_start=warm_start
+        super().__init__(params, defaults, rank, dense_fallback, rank_allocator, oversample, n_iter,
+                         compiled, workers, intra_op_threads, sketch_seed, sketch_refresh)
+
+    def _init_state(self, p):
+        state = self.state[p]
+        if len(state) == 0:
+            if self.rank > min(p.shape):
+                raise ValueError("Invalid rank: {} - exceeds matrix shape {}".format(self.rank, tuple(p.shape)))
+            self._register_rank(p, self.rank)
+            state["step"] = 0
+            # Exponential moving average of gradient values
+
+            state["m_u"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
+            state["m_v"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
+            state["m_s"] = torch.zeros((self.rank), dtype=p.data.dtype, device=p.data.device)
+        return state
+
+    def _state_bytes(self, p, rank):
+        """Bytes ``_init_state`` will allocate for ``p`` at ``rank``."""
+        if p.dim() != 2:
+            return dense_state_bytes(p, 1) if self.dense_fallback else 0
+        return (sum(p.shape) + 1) * rank * p.element_size()
+
+    def _workspace_bytes(self, p, rank):
+        """Bytes of the SVD workspace ``_workspace`` will allocate for ``p`` at ``rank``."""
+        nbytes = tensor_bytes(svd_workspace(*p.shape, rank, self.oversample, dtype=p.dtype, device="meta", n_iter=self.n_iter))
+        if self.foreach:
+            # buckets also stack the factors of their members in the workspace
+            nbytes += (sum(p.shape) + 1) * rank * p.element_size()
+        return nbytes
+
+    def _resize_rank(self, p, rank):
+        state = self.state[p]
+        state["m_u"] = resize_rank(state["m_u"], 1, rank)
+        state["m_s"] = resize_rank(state["m_s"], 0, rank)
+        state["m_v"] = resize_rank(state["m_v"], 0, rank)
+
+    def _dense_step(self, params, grads, group):
+        dense_lion_(params, grads, self.state, group)
+
+    def _step_group(self, group):
+        if self.foreach:
+            self._step_foreach(group)
+            return
+        super()._step_group(group)
+
+    def _step_param(self, p, grad, group):
+        state = self.state[p]
+        if self.tile_size is not None:
+            self._step_tiled(p, grad, state, group)
+            return
+        m_factors = (state["m_u"], state["m_s"], state["m_v"])
+        beta1, beta2 = group["betas"]
+
+        state["step"] += 1
+        hparams = kernel_hparams(self.compiled, beta1=beta1, beta2=beta2, lr=group["lr"],
+                                 decay=group["lr"] * group["weight_decay"])
+        m_ = step_kernel(mlorc_lion_step, self.compiled)(p.data, grad, m_factors, hparams)
+        workspace = self._workspace(p, grad, m_factors[1].shape[0])
+        self._compress(m_, m_factors, state["step"], workspace)
+        self._observe(p, workspace)
+
+    def _step_tiled(self, p, grad, state, group):
+        """Row-tiled version of the per-tensor update.
+
+        The interpolation, its sign, the parameter update and the new momentum
+        are formed ``tile_size`` rows at a time, and each new momentum tile
+        goes straight into the sketch ``Y = M @ Omega``, so neither the old nor
+        the new dense momentum ever exists. The new momentum only depends on
+        the old factors and the gradient, so a second pass rebuilds its tiles
+        to accumulate ``B = Q^T M``.
+        """
+        m_u, m_s, m_v = state["m_u"], state["m_s"], state["m_v"]
+        beta1, beta2 = group["betas"]
+        rows = grad.shape[0]
+
+        state["step"] += 1
+
+        def momentum(i, j):
+            # new momentum rows i:j, beta2 * m + (1-beta2) * grad
+            return torch.addmm(grad[i:j], m_u[i:j] * m_s, m_v, beta=1-beta2, alpha=beta2)
+
+        workspace = self._workspace(p, grad, m_s.shape[0])
+        omega = self._sketch(m_v, state["step"], workspace)
+        Y = workspace["Y"]
+        for i in range(0, rows, self.tile_size):
+            j = min(i + self.tile_size, rows)
+            g = grad[i:j]
+            m = (m_u[i:j] * m_s) @ m_v
+            update = torch.lerp(g, m, beta1).sign_()
+            p_tile = p.data[i:j]
+            p_tile.add_(update, alpha=-group["lr"])
+            if group["weight_decay"] > 0.0:
+                p_tile.add_(p_tile, alpha=-group["lr"] * group["weight_decay"])
+            m.mul_(beta2).add_(g, alpha=1-beta2)
+            torch.matmul(m, omega, out=Y[i:j])
+
+        def tiles():
+            for i in range(0, rows, self.tile_size):
+                j = min(i + self.tile_size, rows)
+                yield (i, j, (momentum(i, j),))
+
+        Q, = streaming_power_iterate(tiles, [workspace], self.n_iter)
+        # B = Q^T M is accumulated in float32 across tiles
+        B = workspace["B_f"].zero_()
+        for i, j, (m,) in tiles():
+            B.addmm_(Q[i:j].mT.float(), m.float())
+        range_svd(Q, B, m_s.shape[0], workspace, out=(m_u, m_s, m_v))
+        self._observe(p, workspace)
+
+    def _step_foreach(self, group):
+        """Multi-tensor version of ``step`` for one param group, bucketed by shape."""
+        matrices, dense_params, dense_grads = self._matrix_grads(group)
+        grads = dict(matrices)
+
+        beta1, beta2 = group["betas"]
+        for bucket in shape_buckets(list(grads), self.bucket_size, lambda p: self.state[p]["m_s"].shape[0]):
+            states = [self.state[p] for p in bucket]
+            grad = torch.stack([grads[p] for p in bucket])
+            workspace = self._workspace(tuple(bucket), grad, states[0]["m_s"].shape[0])
+            m_u, m_s, m_v = stacked_factors(states, ("m_u", "m_s", "m_v"), workspace)
+
+            m = reconstruct(m_u, m_s, m_v)
+            update = (beta1 * m + (1-beta1) * grad).sign_()
+
+            data = [p.data for p in bucket]
+            torch._foreach_add_(data, update.unbind(0), alpha=-group["lr"])
+
+            for state in states:
+                state["step"] += 1
 
-class MLorc_AdamW(Optimizer):
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01, correct_bias=True, rank=4):
+            m.mul_(beta2).add_(grad, alpha=1-beta2)
+            step = min(state["step"] for state in states)
+            self._compress(m, (m_u, m_s, m_v), step, workspace)
+            for k, f in zip(("m_u", "m_s", "m_v"), (m_u, m_s, m_v)):
+                torch._foreach_copy_([state[k] for state in states], f.unbind(0))
+            for i, p in enumerate(bucket):
+                self._observe(p, workspace, i)
+            if group["weight_decay"] > 0.0:
+                torch._foreach_add_(data, data, alpha=-group["lr"] * group["weight_decay"])
+
+        self._dense_step(dense_params, dense_grads, group)
+
+
+def projects_right(shape, proj_side="auto"):
+    """Whether GaLore projects a ``shape`` matrix from the right; "auto" keeps the moments on the shorter side."""
+    if proj_side == "auto":
+        return shape[0] < shape[1]
+    return proj_side == "right"
+
+def galore_state_shapes(shape, rank, proj_side="auto"):
+    """Shapes of GaLore's ``(projector, exp_avg, exp_avg_sq)`` for a ``shape`` matrix."""
+    m, n = reversed(shape) if projects_right(shape, proj_side) else shape
+    return (m, rank), (rank, n), (rank, n)
+
+class GaLore(_LowRankOptimizer):
+    _profile_phases = dict(_LowRankOptimizer._profile_phases, _refresh_projector="refresh")
+    # dense m x n matrices a per-matrix step holds at once: the projected-back update and its scaled copy
+    _step_temporaries = 2
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01, correct_bias=True, rank=4, T=100, dense_fallback=False, rank_allocator=None,
+                 refresh="svd", oversample=0, n_iter=0, warm_start=False, stagger=False, proj_side="auto",
+                 compiled=False, workers=0, intra_op_threads=None, sketch_seed=None, sketch_refresh=1):
+        if proj_side not in ("auto", "left", "right"):
+            raise ValueError("Invalid proj_side: {} - should be 'auto', 'left' or 'right'".format(proj_side))
+        if refresh not in ("svd", "randomized"):
+            raise ValueError("Invalid refresh: {} - should be 'svd' or 'randomized'".format(refresh))
+        if warm_start and (refresh != "randomized" or oversample < 1):
+            raise ValueError("warm_start needs refresh='randomized' and oversample >= 1")
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias)
+        self.T=T
+        # refresh: "svd" recomputes the projector with a full SVD of the gradient, "randomized" with
+        # randomized_svd using `oversample` extra columns and `n_iter` power iterations
+        self.refresh=refresh
+        # warm_start: seed the randomized range finder with the current projector
+        self.warm_start=warm_start
+        # stagger: give each matrix its own refresh phase so only ~1/T of them refresh on any step
+        self.stagger=stagger
+        self._matrices=0
+        # proj_side: "left" keeps rank x n moments, "right" m x rank ones (stored transposed),
+        # "auto" picks the smaller of the two per matrix shape
+        self.proj_side=proj_side
+        # rank_allocator resizes the projection rank
+        super().__init__(params, defaults, rank, dense_fallback, rank_allocator, oversample, n_iter,
+                         compiled, workers, intra_op_threads, sketch_seed, sketch_refresh)
+
+    def _resize_rank(self, p, rank):
+        state = self.state[p]
+        state["projector"] = resize_rank(state["projector"], 1, rank)
+        state["exp_avg"] = resize_rank(state["exp_avg"], 0, rank)
+        state["exp_avg_sq"] = resize_rank(state["exp_avg_sq"], 0, rank)
+
+    def _state_bytes(self, p, rank):
+        """Bytes ``_init_state`` will allocate for ``p`` at ``rank``."""
+        if p.dim() != 2:
+            return dense_state_bytes(p) if self.dense_fallback else 0
+        return p.element_size() * sum(math.prod(s) for s in galore_state_shapes(p.shape, rank, self.proj_side))
+
+    def _refresh_due(self, state):
+        # every matrix also refreshes on its first step, as it has no projector yet
+        return state["step"] == 1 or (state["step"] - 1 + state.get("refresh_offset", 0)) % self.T == 0
+
+    def _refresh_projector(self, p, grad, state, rank):
+        """New left projector of ``p``'s (oriented) ``grad``; returns the singular values it was computed from."""
+        if self.refresh == "svd":
+            u, s, v=torch.linalg.svd(grad.float(), full_matrices=False)
+            u = u[:, :rank]
+        elif self.warm_start and state["step"] > 1:
+            # the projector spans the left singular space, i.e. the range finder input of grad^T
+            _, s, v = randomized_svd(grad.float().mT, rank, state["projector"].float(), self.oversample, n_iter=self.n_iter,
+                                     sketch=self.sketches.for_key(p))
+            u = v.mT
+        else:
+            u, s, _ = randomized_svd(grad.float(), rank, oversample=self.oversample, n_iter=self.n_iter,
+                                     sketch=self.sketches.for_key(p))
+        state["projector"] = u.to(state["projector"].dtype)
+        return s
+
+    def _init_state(self, p):
+        state = self.state[p]
+        if len(state) == 0:
+            projector_shape, moment_shape, _ = galore_state_shapes(p.shape, self.rank, self.proj_side)
+            self._register_rank(p, self.rank)
+            state["step"] = 0
+            state["refresh_offset"] = self._matrices % self.T if self.stagger else 0
+            self._matrices += 1
+            # Exponential moving average of gradient values
+            state["exp_avg"] = torch.zeros(moment_shape, dtype=p.data.dtype, device=p.data.device)
+            state["exp_avg_sq"] = torch.zeros(moment_shape, dtype=p.data.dtype, device=p.data.device)
+            state["projector"] = torch.zeros(projector_shape, dtype=p.data.dtype, device=p.data.device)
+        return state
+
+    def _step_param(self, p, grad, group):
+        state = self.state[p]
+        # a right projection is the left projection of the transposed matrix
+        data = p.data
+        if projects_right(p.shape, self.proj_side):
+            grad, data = grad.mT, data.mT
+
+        exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+        beta1, beta2 = group["betas"]
+
+        state["step"] += 1
+
+        if self._refresh_due(state):
+            s = self._refresh_projector(p, grad, state, exp_avg.shape[0])
+            if self.rank_allocator is not None:
+                self.rank_allocator.observe(p, s)
+
+        hparams = kernel_hparams(self.compiled, beta1=beta1, beta2=beta2, eps=group["eps"],
+                                 step_size=self._step_size(group, state["step"]))
+        step_kernel(galore_step, self.compiled)(data, grad, state["projector"], exp_avg, exp_avg_sq, hparams)
+
+        if group["weight_decay"] > 0.0:
+            p.data.add_(p.data, alpha=-group["lr"] * group["weight_decay"])
+
+def gram_cholesky(G, delta=1e-8, max_tries=7):
+    """Cholesky factor of the rank x rank Gram matrix ``G`` with a relative jitter of ``delta``.
+
+    Rank-deficient factors leave ``G`` singular up to round-off, so a failed
+    factorization is retried with ten times the jitter, up to ``max_tries`` times.
+    In a stack of Grams only the ones that failed get the larger jitter.
+    """
+    eye = torch.eye(G.shape[-1], dtype=G.dtype, device=G.device)
+    jitter = delta * G.diagonal(dim1=-2, dim2=-1).mean(-1, keepdim=True).unsqueeze(-1) + torch.finfo(G.dtype).tiny
+    for _ in range(max_tries):
+        L, info = torch.linalg.cholesky_ex(G + jitter * eye)
+        if not info.any():
+            return L
+        jitter = torch.where(info[..., None, None] > 0, jitter * 10, jitter)
+    return torch.linalg.cholesky(G + jitter * eye)
+
+def init_factor_grams(A, B, delta=1e-8):
+    """Gram matrices of the factors of ``A @ B`` and their Cholesky factors, in float32."""
+    A_f, B_f = A.float(), B.float()
+    AtA, BBt = A_f.mT @ A_f, B_f @ B_f.mT
+    return dict(AtA=AtA, BBt=BBt, L_A=gram_cholesky(AtA, delta), L_B=gram_cholesky(BBt, delta))
+
+def projected_factor_update_(A, B, grams, G, beta, delta=1e-8):
+    """Fold ``G`` into ``A @ B`` as ``beta * A @ B + (1 - beta) * G``, truncated back to rank r.
+
+    Only the projection of ``G`` on the tangent space at ``A @ B`` is kept,
+    ``A C B + g_A B + A g_B`` with the rank x rank core
+    ``C = (A^T A)^-1 A^T G B^T (B B^T)^-1`` and ``g_A``, ``g_B`` orthogonal
+    to ``A``, ``B``; the Gram solves use the cached Cholesky factors in
+    ``grams``. The new moment is then ``[A, g_A] K [B; g_B]`` with
+    ``K = [[beta I + (1 - beta) C, (1 - beta) I], [(1 - beta) I, 0]]``, so
+    QR of the two 2r-wide factors and the SVD of the 2r x 2r core
+    ``R_A K R_B^T`` give its best rank-r approximation, rebuilt as the
+    balanced factors ``Q_A U sqrt(S)`` and ``sqrt(S) V^T Q_B^T``. Both of
+    their Grams are ``diag(S)``, which replaces ``grams`` in place.
+    """
+    rank = A.shape[1]
+    A_f, B_f = A.float(), B.float()
+    L_A, L_B = grams["L_A"], grams["L_B"]
+
+    GBt = torch.cholesky_solve((G @ B.mT).float().mT, L_B).mT  # G B^T (B B^T)^-1
+    core = torch.cholesky_solve(A_f.mT @ GBt, L_A)            # (A^T A)^-1 A^T G B^T (B B^T)^-1
+    g_A = GBt - A_f @ core
+    g_B = torch.cholesky_solve((A.mT @ G).float(), L_A)
+    g_B -= torch.cholesky_solve(B_f @ g_B.mT, L_B).mT @ B_f
+
+    d = 1 - beta
+    eye = torch.eye(rank, dtype=core.dtype, device=core.device)
+    K = torch.cat([torch.cat([core.mul_(d).add_(eye, alpha=beta), d * eye], dim=1),
+                   torch.cat([d * eye, torch.zeros_like(eye)], dim=1)])
+    Q_A, R_A = torch.linalg.qr(torch.cat([A_f, g_A], dim=1))
+    Q_B, R_B = torch.linalg.qr(torch.cat([B_f, g_B]).mT)
+    U, S, Vh = torch.linalg.svd(R_A @ K @ R_B.mT)
+    S = S[:rank]
+    root = S.sqrt()
+    A.copy_(Q_A @ (U[:, :rank] * root))
+    B.copy_((root.unsqueeze(-1) * Vh[:rank]) @ Q_B.mT)
+    for gram, chol in (("AtA", "L_A"), ("BBt", "L_B")):
+        grams[gram] = torch.diag_embed(S)
+        grams[chol] = gram_cholesky(grams[gram], delta)
+
+def factor_spectrum(grams):
+    """Singular values of ``A @ B`` from the cached Cholesky factors of its Grams."""
+    return torch.linalg.svdvals(grams["L_A"].mT @ grams["L_B"])
+
+def resize_factors(A, B, grams, rank, pad_scale=1e-3):
+    """Balanced factors of ``A @ B`` with ``rank`` columns/rows, and their Grams.
+
+    ``A @ B = (A L_A^-T) (L_A^T L_B) (L_B^-1 B)`` with orthonormal outer
+    terms, so the SVD of the rank x rank core gives the balanced factors
+    ``A L_A^-T U sqrt(S)`` and ``sqrt(S) V^T L_B^-1 B``. Shrinking keeps the
+    leading directions; growing appends random directions orthogonal to the
+    existing ones, scaled by ``pad_scale`` times the smallest kept factor
+    norm, so the new Grams stay well conditioned while ``A @ B`` barely moves.
+    """
+    datatype = A.dtype
+    L_A, L_B = grams["L_A"], grams["L_B"]
+    U, S, Vh = torch.linalg.svd(L_A.mT @ L_B)
+    keep = min(rank, S.shape[-1])
+    root = S[:keep].sqrt()
+    A_f = torch.linalg.solve_triangular(L_A, A.float().mT, upper=False).mT @ (U[:, :keep] * root)
+    B_f = (root.unsqueeze(-1) * Vh[:keep]) @ torch.linalg.solve_triangular(L_B, B.float(), upper=False)
+    if rank > keep:
+        scale = pad_scale * root[-1].clamp_min(1e-12)
+        Q_A = torch.linalg.qr(torch.cat([A_f, torch.randn(A.shape[0], rank - keep, device=A.device)], dim=1))[0]
+        Q_B = torch.linalg.qr(torch.cat([B_f.mT, torch.randn(B.shape[1], rank - keep, device=B.device)], dim=1))[0]
+        A_f = torch.cat([A_f, scale * Q_A[:, keep:]], dim=1)
+        B_f = torch.cat([B_f, scale * Q_B[:, keep:].mT], dim=0)
+    A, B = A_f.to(datatype), B_f.to(datatype)
+    return A, B, init_factor_grams(A, B)
+
+class MLorc_AdamW(_LowRankOptimizer):
+    _profile_phases = dict(_LowRankOptimizer._profile_phases, _update_factors="factor_update")
+    # dense m x n matrices a per-matrix step holds at once: m, sq, denom and the update
+    _step_temporaries = 4
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01, correct_bias=True, rank=4,
+                 dense_fallback=False, factor_update=False, gram_refresh=100, rank_allocator=None,
+                 oversample=0, n_iter=0, compiled=False, workers=0, intra_op_threads=None, sketch_seed=None, sketch_refresh=1):
         if lr < 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
         if not 0.0 <= betas[0] < 1.0:
@@ -280,97 +1585,296 @@ class MLorc_AdamW(Optimizer):
         if not 0.0 <= eps:
             raise ValueError("Invalid epsilon value: {} - should be >= 0.0".format(eps))
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias)
-        self.rank=rank
-        super().__init__(params, defaults)
-
-    def step(self, closure=None):
-        """Performs a single optimization step.
-        Arguments:
-            closure (callable, optional): A closure that reevaluates the model
-                and returns the loss.
-        """
-        loss = None
-        if closure is not None:
-            loss = closure()
-
-        for group in self.param_groups:
+        if gram_refresh < 1:
+            raise ValueError("Invalid gram_refresh: {} - should be >= 1".format(gram_refresh))
+        # factor_update: fold every gradient into m_A/m_B/sq_A/sq_B through the tangent space of their product,
+        # solving with cached Gram Cholesky factors, re-formed exactly every gram_refresh steps against round-off
+        self.factor_update=factor_update
+        self.gram_refresh=gram_refresh
+        # rank_allocator spectra come from the cached Grams, so ranks only adapt together with factor_update;
+        # the range finder (oversample, n_iter, sketch_seed) only seeds the factors on the first step
+        super().__init__(params, defaults, rank, dense_fallback, rank_allocator, oversample, n_iter,
+                         compiled, workers, intra_op_threads, sketch_seed, sketch_refresh)
+
+    def _resize_rank(self, p, rank):
+        state = self.state[p]
+        for prefix in ("m_", "sq_"):
+            A, B = state[prefix + "A"], state[prefix + "B"]
+            if prefix + "grams" in state:
+                A, B, state[prefix + "grams"] = resize_factors(A, B, state[prefix + "grams"], rank)
+            else:
+                A, B = resize_rank(A, 1, rank), resize_rank(B, 0, rank)
+            state[prefix + "A"], state[prefix + "B"] = A, B
+
+    def _state_bytes(self, p, rank):
+        """Bytes ``_init_state`` and the first ``_update_factors`` will allocate for ``p`` at ``rank``."""
+        if p.dim() != 2:
+            return dense_state_bytes(p) if self.dense_fallback else 0
+        factors = 2 * sum(p.shape) * rank * p.element_size()
+        # factor_update also keeps AtA, BBt and their Cholesky factors per moment, rank x rank in float32
+        return factors + (2 * 4 * 4 * rank * rank if self.factor_update else 0)
+
+    def _update_factors(self, p, state, grad, m, sq, beta1, beta2):
+        """Fold the new gradient into ``m_A @ m_B`` and ``sq_A @ sq_B``."""
+        m_A, m_B, sq_A, sq_B = state["m_A"], state["m_B"], state["sq_A"], state["sq_B"]
+        if state["step"] == 1:
+            # the zero-initialised factors have singular Grams, so seed them from the first moments
+            for A, B, M, prefix in ((m_A, m_B, m, "m_"), (sq_A, sq_B, sq, "sq_")):
+                U, S, V = randomized_svd(M, A.shape[1], oversample=self.oversample, n_iter=self.n_iter,
+                                         sketch=self.sketches.for_key((p, prefix)))
+                S = S.sqrt()
+                A.copy_(U * S)
+                B.copy_(S.unsqueeze(-1) * V)
+                state[prefix + "grams"] = init_factor_grams(A, B)
+            return
+
+        projected_factor_update_(m_A, m_B, state["m_grams"], grad, beta1)
+        projected_factor_update_(sq_A, sq_B, state["sq_grams"], grad * grad, beta2)
+        if state["step"] % self.gram_refresh == 0:
+            state["m_grams"] = init_factor_grams(m_A, m_B)
+            state["sq_grams"] = init_factor_grams(sq_A, sq_B)
+        if self.rank_allocator is not None and self.rank_allocator.due:
+            self.rank_allocator.observe(p, factor_spectrum(state["m_grams"]))
+
+    def _init_state(self, p):
+        state = self.state[p]
+        if len(state) == 0:
+            self._register_rank(p, self.rank)
+            state["step"] = 0
+            # Exponential moving average of gradient values
+            state["m_A"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
+            state["m_B"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
+            # Exponential moving average of squared gradient values
+            state["sq_A"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
+            state["sq_B"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
+        return state
+
+    def _step_param(self, p, grad, group):
+        state = self.state[p]
+        beta1, beta2 = group["betas"]
+
+        state["step"] += 1
+
+        # Just adding the square of the weights to the loss function is *not*
+        # the correct way of using L2 regularization/weight decay with Adam,
+        # since that will interact with the m and v parameters in strange ways.
+        # The kernel decays the weights directly instead, after the update.
+        hparams = kernel_hparams(self.compiled, beta1=beta1, beta2=beta2, eps=group["eps"],
+                                 step_size=self._step_size(group, state["step"]), decay=group["lr"] * group["weight_decay"])
+        m, sq = step_kernel(mlorc_adamw_ab_step, self.compiled)(
+            p.data, grad, (state["m_A"], state["m_B"]), (state["sq_A"], state["sq_B"]), hparams)
+        if self.factor_update:
+            self._update_factors(p, state, grad, m, sq, beta1, beta2)
+
+def _step_view(optimizer, group, params):
+    """Update ``params`` of ``group`` alone: through ``_step_group``, or ``step`` on a swapped-in view."""
+    view = dict(group, params=params)
+    step_group = getattr(optimizer, "_step_group", None)
+    if step_group is not None:
+        step_group(view)
+        return
+    param_groups = optimizer.param_groups
+    optimizer.param_groups = [view]
+    try:
+        optimizer.step()
+    finally:
+        optimizer.param_groups = param_groups
+
+def _end_step(optimizer, scheduler):
+    """Once-per-step work after updates that bypassed ``optimizer.step()``."""
+    finish_step = getattr(optimizer, "_finish_step", None)
+    if finish_step is not None:
+        finish_step()
+    if scheduler is not None:
+        # the updates bypassed optimizer.step(), which is what normally marks the optimizer as stepped
+        optimizer._opt_called = True
+        scheduler.step()
+
+class LayerwiseOptimizer:
+    """Runs ``optimizer`` one parameter at a time, as soon as its gradient is accumulated.
+
+    A post-accumulate-grad hook on every trainable parameter updates that
+    parameter alone and frees its gradient, so at most one gradient is alive
+    during backward. The optimizers in this file update a single-parameter
+    view of the parameter's group through ``_step_group``; any other
+    ``torch.optim.Optimizer`` gets its ``step`` called on such a view. Work
+    that belongs to the whole step (``_finish_step``) and ``scheduler.step()``
+    run once, when the backward pass completes, so one scheduler drives the
+    learning rate of every parameter.
+
+    Arguments:
+        optimizer (Optimizer): optimizer over all parameters.
+        scheduler (optional): learning rate scheduler of ``optimizer``.
+    """
+
+    def __init__(self, optimizer, scheduler=None):
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self._groups = {}
+        self._handles = []
+        self._pending = False
+        for group in optimizer.param_groups:
             for p in group["params"]:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-
-                if p.grad.data.dim() != 2:
-                    continue
-                if p.grad.data.is_sparse:
-                    raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
-
-
-                state = self.state[p]
-                beta1, beta2 = group["betas"]
-
-                # State initialization
-                if len(state) == 0:
-                    state["step"] = 0
-                    # Exponential moving average of gradient values
-                    state["m_A"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
-                    state["m_B"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
-                    # Exponential moving average of squared gradient values
-                    state["sq_A"] = torch.zeros((p.data.shape[0], self.rank), dtype=p.data.dtype, device=p.data.device)
-                    state["sq_B"] = torch.zeros((self.rank, p.data.shape[1]), dtype=p.data.dtype, device=p.data.device)
-
-                state["step"] += 1
-                step_size = group["lr"]
-                if 'correct_bias' in group and group["correct_bias"]:  # No bias correction for Bert
-                    bias_correction1 = 1.0 - beta1 ** state["step"]
-                    bias_correction2 = 1.0 - beta2 ** state["step"]
-                    step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
-
-                m = beta1 * state["m_A"] @ state["m_B"] + (1-beta1) * grad
-                denom = torch.abs(beta2 * state["sq_A"] @ state["sq_B"] + (1-beta2) * grad * grad).sqrt().add_(group["eps"])
-                p.data.addcdiv_(-step_size, m, denom)
-                if 1==1:
-                    pass
-                    
-                else:
-
-                    m_A, m_B, sq_A, sq_B = state["m_A"], state["m_B"], state["sq_A"], state["sq_B"]
-                    delta = 1e-8
-
-                    # computing the inverse matrix
-                    m_A_TA = m_A.T @ m_A
-                    m_BB_T = m_B @ m_B.T
-                    m_A_TA_inv = torch.linalg.pinv(m_A_TA + delta * torch.eye(m_A.shape[1]).to(m_A.device)).bfloat16()
-                    m_BB_T_inv = torch.linalg.pinv(m_BB_T + delta * torch.eye(m_B.shape[0]).to(m_B.device)).bfloat16()
-                    g_mA = grad @ m_B.T @ m_BB_T_inv
-                    g_mA_projected = g_mA - m_A @ m_A_TA_inv @ (m_A.T @ g_mA)
-                    g_mB = m_A_TA_inv @ m_A.T @ grad
-                    g_mB_projected = g_mB - (g_mB @ m_B.T) @ m_BB_T_inv @ m_B
-
-                    sq_A_TA = sq_A.T @ sq_A
-                    sq_BB_T = sq_B @ sq_B.T
-                    sq_A_TA_inv = torch.linalg.pinv(sq_A_TA + delta * torch.eye(sq_A.shape[1]).to(sq_A.device)).bfloat16()
-                    sq_BB_T_inv = torch.linalg.pinv(sq_BB_T + delta * torch.eye(sq_B.shape[0]).to(sq_B.device)).bfloat16()
-                    g_sqA = (grad*grad) @ sq_B.T @ sq_BB_T_inv
-                    g_sqA_projected = g_sqA - sq_A @ sq_A_TA_inv @ (sq_A.T @ g_sqA)
-                    g_sqB = sq_A_TA_inv @ sq_A.T @ (grad*grad)
-                    g_sqB_projected = g_sqB - (g_sqB @ sq_B.T) @ sq_BB_T_inv @ sq_B
-
-                    m_A.mul_(0.5+0.5*beta1).add_(g_mA_projected, alpha=1 - beta1)
-                    m_B.mul_(0.5+0.5*beta1).add_(g_mB_projected, alpha=1 - beta1)
-
-                    sq_A.mul_(0.5+0.5*beta2).add_(g_sqA_projected, alpha=1 - beta2)
-                    sq_B.mul_(0.5+0.5*beta2).add_(g_sqB_projected, alpha=1 - beta2)
-                    state["m_A"], state["m_B"], state["sq_A"], state["sq_B"] = m_A, m_B, sq_A, sq_B 
-
-                # Just adding the square of the weights to the loss function is *not*
-                # the correct way of using L2 regularization/weight decay with Adam,
-                # since that will interact with the m and v parameters in strange ways.
-                #
-                # Instead we want to decay the weights in a manner that doesn't interact
-                # with the m/v parameters. This is equivalent to adding the square
-                # of the weights to the loss with plain (non-momentum) SGD.
-                # Add weight decay at the end (fixed version)
-                if group["weight_decay"] > 0.0:
-                    p.data.add_(p.data, alpha=-group["lr"] * group["weight_decay"])
-
-        return loss  
+                if p.requires_grad:
+                    self._groups[p] = group
+                    self._handles.append(p.register_post_accumulate_grad_hook(self._hook))
+
+    def _hook(self, p):
+        if p.grad is None:
+            return
+        if not self._pending:
+            torch.autograd.Variable._execution_engine.queue_callback(self._finish_backward)
+            self._pending = True
+        _step_view(self.optimizer, self._groups[p], [p])
+        p.grad = None
+
+    def _finish_backward(self):
+        self._pending = False
+        _end_step(self.optimizer, self.scheduler)
+
+    def remove(self):
+        """Unregister the hooks."""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+def sketch_sizes(rank, oversample):
+    """Widths ``(k, l)`` of the range sketch ``Y`` and co-range sketch ``W`` of ``LowRankGradAccumulator``."""
+    k = rank + oversample
+    return k, 2 * k + 1
+
+class LowRankGradAccumulator:
+    """Accumulates gradients over micro-batches, keeping the matrices' in low-rank sketches.
+
+    A post-accumulate-grad hook folds every matrix gradient ``G`` into a
+    two-sided sketch (Tropp et al.'s streaming sketch, ``Y += G @ Omega`` and
+    ``W += Psi^T @ G``) and frees it, so between optimizer steps a matrix
+    holds ``m * k + l * n`` float32 values (``k, l = sketch_sizes(rank,
+    oversample)``) instead of a dense gradient. Other parameters accumulate
+    their ``.grad`` as usual. After ``accumulation_steps`` backward passes
+    each matrix's mean gradient is recovered from its sketch as a
+    rank-``rank`` SVD, expanded and stepped one matrix at a time, so as with
+    ``LayerwiseOptimizer`` at most one dense matrix gradient is alive; then
+    ``_finish_step`` and ``scheduler.step()`` run once. Losses need no
+    ``1 / accumulation_steps`` scaling, the gradients are averaged here.
+
+    The Gaussian test matrices ``Omega`` (``n x k``) and ``Psi`` (``m x l``)
+    are drawn once per matrix shape and shared. Matrices too small for the
+    sketch to save memory (``k + l > min(m, n)``) stay dense.
+
+    Arguments:
+        optimizer (Optimizer): optimizer over all parameters.
+        accumulation_steps (int): backward passes per optimizer step.
+        rank (int, optional): rank of the accumulated matrix gradients (default: ``optimizer.rank``).
+        oversample (int): extra sketch columns on top of ``rank``.
+        scheduler (optional): learning rate scheduler of ``optimizer``.
+    """
+
+    def __init__(self, optimizer, accumulation_steps, rank=None, oversample=8, scheduler=None):
+        if accumulation_steps < 1:
+            raise ValueError("Invalid accumulation_steps: {} - should be >= 1".format(accumulation_steps))
+        if oversample < 0:
+            raise ValueError("Invalid oversample: {} - should be >= 0".format(oversample))
+        self.optimizer = optimizer
+        self.accumulation_steps = accumulation_steps
+        self.rank = rank if rank is not None else optimizer.rank
+        self.oversample = oversample
+        self.scheduler = scheduler
+        self.micro_steps = 0
+        k, l = sketch_sizes(self.rank, oversample)
+        self._sketched = {p for group in optimizer.param_groups for p in group["params"]
+                          if p.requires_grad and p.dim() == 2 and k + l <= min(p.shape)}
+        self._sketches = {}
+        self._test_matrices = {}
+        self._workspaces = {}
+        self._fed = set()
+        self._pending = False
+        self._handles = [p.register_post_accumulate_grad_hook(self._hook)
+                         for group in optimizer.param_groups for p in group["params"] if p.requires_grad]
+
+    def sketch_bytes(self):
+        """Bytes of the sketches and shared test matrices, predicted from the shapes before the first backward."""
+        k, l = sketch_sizes(self.rank, self.oversample)
+        nbytes = sum(4 * (p.shape[0] * k + l * p.shape[1]) for p in self._sketched)
+        shapes = {(tuple(p.shape), p.device) for p in self._sketched}
+        return nbytes + sum(4 * (n * k + m * l) for (m, n), _ in shapes)
+
+    def _omega_psi(self, p):
+        key = (tuple(p.shape), p.device)
+        if key not in self._test_matrices:
+            (m, n), (k, l) = p.shape, sketch_sizes(self.rank, self.oversample)
+            self._test_matrices[key] = (sketch_matrix(n, self.rank, oversample=self.oversample, device=p.device),
+                                        sketch_matrix(m, l, device=p.device))
+        return self._test_matrices[key]
+
+    def _hook(self, p):
+        if p.grad is None:
+            return
+        if not self._pending:
+            torch.autograd.Variable._execution_engine.queue_callback(self._finish_backward)
+            self._pending = True
+        if p not in self._sketched:
+            return  # autograd keeps accumulating into the dense .grad
+        omega, psi = self._omega_psi(p)
+        sketch = self._sketches.get(p)
+        if sketch is None:
+            sketch = self._sketches[p] = dict(Y=torch.zeros((p.shape[0], omega.shape[1]), device=p.device),
+                                              W=torch.zeros((psi.shape[1], p.shape[1]), device=p.device))
+        grad = p.grad.float()
+        sketch["Y"].addmm_(grad, omega)
+        sketch["W"].addmm_(psi.mT, grad)
+        self._fed.add(p)
+        p.grad = None
+
+    def _decompress(self, p):
+        """Rank-``rank`` ``(U, S, V)`` of the gradient sum sketched for ``p``, in float32."""
+        sketch = self._sketches[p]
+        _, psi = self._omega_psi(p)
+        key = (tuple(p.shape), p.device)
+        if key not in self._workspaces:
+            self._workspaces[key] = svd_workspace(*p.shape, self.rank, self.oversample, device=p.device)
+        workspace = self._workspaces[key]
+        Q = orthonormalize(sketch["Y"], workspace)
+        # the co-range sketch pins down the coefficients X of the sum in the basis Q: (Psi^T Q) X = W
+        X = torch.linalg.lstsq(psi.mT @ Q, sketch["W"]).solution
+        return range_svd(Q, X, self.rank, workspace)
+
+    def _finish_backward(self):
+        self._pending = False
+        self.micro_steps += 1
+        if self.micro_steps == self.accumulation_steps:
+            self._step()
+
+    def _step(self):
+        count = self.micro_steps
+        for group in self.optimizer.param_groups:
+            dense = []
+            for p in group["params"]:
+                if p in self._fed:
+                    U, S, V = self._decompress(p)
+                    p.grad = reconstruct(U, S / count, V).to(p.dtype)
+                    _step_view(self.optimizer, group, [p])
+                    p.grad = None
+                    self._sketches[p]["Y"].zero_()
+                    self._sketches[p]["W"].zero_()
+                elif p.grad is not None:
+                    dense.append(p)
+            if dense:
+                torch._foreach_div_([p.grad for p in dense], count)
+                _step_view(self.optimizer, group, dense)
+                for p in dense:
+                    p.grad = None
+        self._fed.clear()
+        self.micro_steps = 0
+        _end_step(self.optimizer, self.scheduler)
+
+    def flush(self):
+        """Step on the micro-batches accumulated so far, e.g. the remainder at the end of an epoch."""
+        if self.micro_steps > 0:
+            self._step()
+
+    def remove(self):
+        """Unregister the hooks."""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
@@ -0,0 +1,245 @@
+"""Opt-in per-phase timing of the optimizer steps in optim.py.
+
+``StepProfiler`` times the phases of a step (dense moment reconstruction,
+the QR / SVD of the randomized range finder, the elementwise update, ...)
+per parameter, and aggregates them per step:
+
+    profiler = StepProfiler(optimizer, model.named_parameters()).attach()
+    ...  # train a few steps
+    profiler.detach()
+    profiler.log(log.info)
+    profiler.export_chrome_trace("optimizer_trace.json")  # chrome://tracing or Perfetto
+
+Nothing in optim.py checks for a profiler: ``attach`` wraps the optimizer's
+own methods listed in its ``_profile_phases`` and the module-level helpers
+in ``MODULE_PHASES``, and ``detach`` puts the originals back, so a detached
+(or never attached) profiler costs nothing. Times are exclusive: the
+``compress`` phase does not include the ``qr`` and ``svd`` calls it makes.
+With ``compiled=True`` the reconstruction runs inside the compiled kernel and
+is counted as ``update``.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import torch
+
+import optim
+from Mylog import TitledLog
+
+# module-level functions of optim.py, by phase; optimizer classes list their own methods in _profile_phases
+MODULE_PHASES = {
+    "reconstruct": "reconstruct",
+    "sketch_matrix": "sketch",
+    "orthonormalize": "qr",
+    "power_iterate": "power_iteration",
+    "range_svd": "svd",
+    "dense_adamw_": "dense",
+    "dense_lion_": "dense",
+}
+
+
+class StepProfiler:
+    """Collects per-parameter, per-phase timings of ``optimizer``'s steps.
+
+    ``named_parameters`` (e.g. ``model.named_parameters()``) names the
+    parameters in the report; without it they are numbered. ``synchronize``
+    waits for CUDA around every phase, which is needed for meaningful GPU
+    timings; it defaults to whether any parameter lives on a CUDA device.
+    """
+
+    def __init__(self, optimizer, named_parameters=None, synchronize=None):
+        self.optimizer = optimizer
+        params = [p for group in optimizer.param_groups for p in group["params"]]
+        if named_parameters is not None:
+            names = {p: name for name, p in named_parameters}
+        else:
+            names = {p: "param{}".format(i) for i, p in enumerate(params)}
+        self._names = {p.data_ptr(): names.get(p, "?") for p in params}
+        self._state_names = {}
+        if synchronize is None:
+            synchronize = any(p.is_cuda for p in params)
+        self.synchronize = synchronize
+        self.events = []
+        self.steps = 0
+        self._local = threading.local()
+        self._patched = []
+
+    def attach(self):
+        """Start timing; returns ``self``."""
+        if self._patched:
+            return self
+        for name, phase in getattr(type(self.optimizer), "_profile_phases", {}).items():
+            self._patch(self.optimizer, name, self._timed(getattr(self.optimizer, name), phase))
+        self._patch(self.optimizer, "step", self._timed(self.optimizer.step, "step"))
+        # a step ends once _finish_step returns, whether it came from step() or a LayerwiseOptimizer
+        if hasattr(self.optimizer, "_finish_step"):
+            self._patch(self.optimizer, "_finish_step", self._counted(self.optimizer._finish_step))
+        else:
+            # torch AdamW, lion_pytorch: LayerwiseOptimizer and LowRankGradAccumulator call step() once per
+            # parameter through _step_view, and end the step in _end_step
+            step = self.optimizer.step
+            self._patch(self.optimizer, "step", self._counted(step, lambda *args: not self._stack().view))
+            self._patch(optim, "_step_view", self._viewed(optim._step_view))
+            self._patch(optim, "_end_step", self._counted(optim._end_step, lambda opt, *args: opt is self.optimizer))
+        for name, phase in MODULE_PHASES.items():
+            self._patch(optim, name, self._timed(getattr(optim, name), phase, nested_only=True))
+        kernel = optim.step_kernel
+        self._patch(optim, "step_kernel", lambda fn, compiled=False: self._timed(kernel(fn, compiled), "update",
+                                                                                 nested_only=True))
+        return self
+
+    def detach(self):
+        """Stop timing and restore the original methods; the collected events are kept."""
+        for owner, name, original, owned in reversed(self._patched):
+            if owned:
+                setattr(owner, name, original)
+            else:  # the wrapper shadowed a method of the optimizer's class
+                delattr(owner, name)
+        self._patched = []
+        return self
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.detach()
+
+    def _patch(self, owner, name, wrapper):
+        self._patched.append((owner, name, getattr(owner, name), name in vars(owner)))
+        setattr(owner, name, wrapper)
+
+    def _stack(self):
+        local = self._local
+        if not hasattr(local, "stack"):
+            local.stack, local.param, local.view = [], None, False
+        return local
+
+    def _param_name(self, args):
+        # the first argument that is one of our parameters (or its state dict) names the phase
+        for a in args:
+            if torch.is_tensor(a):
+                name = self._names.get(a.data_ptr())
+                if name is not None:
+                    return name
+            elif isinstance(a, dict):
+                if "params" in a:  # a param group: foreach buckets and dense fallbacks span parameters
+                    return "*"
+                name = self._state_names.get(id(a))
+                if name is None:
+                    self._state_names = {id(s): self._names.get(p.data_ptr(), "?")
+                                         for p, s in self.optimizer.state.items()}
+                    name = self._state_names.get(id(a))
+                if name is not None:
+                    return name
+        return None
+
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def _timed(self, fn, phase, nested_only=False):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if torch.compiler.is_compiling():
+                return fn(*args, **kwargs)
+            local = self._stack()
+            # module-level helpers are shared by every optimizer, only time them inside our steps
+            if nested_only and not local.stack:
+                return fn(*args, **kwargs)
+            param = self._param_name(args)
+            if param is not None:
+                local.param = param
+            elif phase == "step":
+                local.param = None
+            param = local.param
+            self._sync()
+            frame = [0.0]  # time spent in nested phases
+            local.stack.append(frame)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._sync()
+                duration = time.perf_counter() - start
+                local.stack.pop()
+                if local.stack:
+                    local.stack[-1][0] += duration
+                self.events.append(dict(phase=phase, param=param, step=self.steps, start=start,
+                                        duration=duration, self_time=duration - frame[0],
+                                        thread=threading.get_ident()))
+        return wrapper
+
+    def _counted(self, fn, ends_step=None):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                if ends_step is None or ends_step(*args):
+                    self.steps += 1
+        return wrapper
+
+    def _viewed(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            local = self._stack()
+            outer, local.view = local.view, True
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                local.view = outer
+        return wrapper
+
+    def summary(self):
+        """Exclusive time per phase: ``{phase: dict(calls, total_ms, ms_per_step, percent)}``, slowest first."""
+        totals, calls = defaultdict(float), defaultdict(int)
+        for e in self.events:
+            totals[e["phase"]] += e["self_time"]
+            calls[e["phase"]] += 1
+        total = sum(totals.values()) or 1.0
+        steps = max(1, self.steps)
+        return {phase: dict(calls=calls[phase], total_ms=1e3 * t, ms_per_step=1e3 * t / steps,
+                            percent=100.0 * t / total)
+                for phase, t in sorted(totals.items(), key=lambda kv: -kv[1])}
+
+    def param_summary(self):
+        """Exclusive time per parameter: ``{name: {phase: ms_per_step}}``, slowest parameter first."""
+        per_param = defaultdict(lambda: defaultdict(float))
+        for e in self.events:
+            if e["param"] is not None and e["phase"] != "step":
+                per_param[e["param"]][e["phase"]] += 1e3 * e["self_time"] / max(1, self.steps)
+        return dict(sorted(((name, dict(phases)) for name, phases in per_param.items()),
+                           key=lambda kv: -sum(kv[1].values())))
+
+    def step_summary(self):
+        """Exclusive ms per phase for every step: ``[{phase: ms}]``."""
+        steps = [defaultdict(float) for _ in range(self.steps + 1)]
+        for e in self.events:
+            steps[e["step"]][e["phase"]] += 1e3 * e["self_time"]
+        return [dict(s) for s in steps if s]
+
+    def log(self, log_fn=print, top=10):
+        """Report the per-phase totals and the ``top`` slowest parameters through ``log_fn``."""
+        with TitledLog("optimizer step profile: {} steps".format(self.steps), log_fn=log_fn):
+            log_fn("{:<16} {:>12} {:>8} {:>8}".format("phase", "ms/step", "%", "calls"))
+            for phase, row in self.summary().items():
+                log_fn("{:<16} {:>12.3f} {:>8.1f} {:>8}".format(phase, row["ms_per_step"], row["percent"], row["calls"]))
+            for name, phases in list(self.param_summary().items())[:top]:
+                slowest = sorted(phases.items(), key=lambda kv: -kv[1])[:3]
+                log_fn("{}: {:.3f} ms/step ({})".format(name, sum(phases.values()),
+                                                        ", ".join("{} {:.3f}".format(k, v) for k, v in slowest)))
+
+    def export_chrome_trace(self, path):
+        """Write the events in the Chrome trace event format, one complete ("X") event per phase call."""
+        origin = min((e["start"] for e in self.events), default=0.0)
+        threads = {t: i for i, t in enumerate(dict.fromkeys(e["thread"] for e in self.events))}
+        trace = [dict(name=e["phase"], cat="optimizer", ph="X", pid=os.getpid(), tid=threads[e["thread"]],
+                      ts=1e6 * (e["start"] - origin), dur=1e6 * e["duration"],
+                      args=dict(param=e["param"], step=e["step"]))
+                 for e in self.events]
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=trace, displayTimeUnit="ms"), f)
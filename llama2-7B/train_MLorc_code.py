@@ -18,7 +18,9 @@ from tqdm import tqdm
 from Mylog import TitledLog
 import Preprocessing
 from Preprocessing import load_codefeedback, CodeFeedback100k_Preprocessor
-from optim import MLorc_AdamW, MLorc_Lion, GaLore
+from optim import MLorc_AdamW, MLorc_Lion, GaLore, LayerwiseOptimizer, LowRankGradAccumulator
+from checkpoint import save_optimizer_state, load_optimizer_state
+from profiling import StepProfiler
 
 
 
@@ -38,7 +40,23 @@ config = {
     "learning_rate": 4e-5,
     "optimizer": "MLorc_AdamW",
     "GaLore_T": 300,
+    "GaLore_refresh": "svd",  # "randomized" recomputes the projector with randomized_svd instead of a full SVD
+    "GaLore_stagger": False,  # spread projector refreshes so only ~1/GaLore_T of the matrices refresh per step
     "layer_wise_flag": False,
+    "grad_accumulation_steps": 1,  # micro-batches per optimizer step; above 1 matrix gradients are kept as low-rank sketches in between
+    "grad_accumulation_rank": 32,  # rank of the accumulated matrix gradients
+    "grad_accumulation_oversample": 8,  # extra sketch columns on top of grad_accumulation_rank
+    "dense_fallback": False,  # also train norm weights inside the MLorc/GaLore optimizer
+    "factor_update": False,  # MLorc_AdamW: keep A @ B moment factors; oversample, n_iter and sketch_* only affect it with this on
+    "oversample": 0,  # extra random columns in the MLorc randomized SVD sketch
+    "n_iter": 0,  # power iterations of the MLorc randomized SVD, see `python benchmark.py range_finder`
+    "optimizer_workers": 0,  # update this many matrices at once on a thread pool (CPU runs); 0 steps them one by one
+    "intra_op_threads": None,  # torch threads per optimizer worker, None for an even share of the cores
+    "sketch_seed": None,  # seed per-matrix generators for the randomized SVD test matrices, making runs reproducible
+    "sketch_refresh": 1,  # reuse each seeded test matrix for this many steps before drawing a new one
+    "save_optimizer_state": False,  # write sharded optimizer state next to the model at the end of training
+    "resume_optimizer_state": None,  # directory written by a previous run, loaded lazily before training
+    "profile_optimizer_steps": 0,  # time the phases of the first N optimizer steps, logged and saved as a Chrome trace
     "weight_decay": 0,
     "warmup_ratio": 0.03,
     "bf16": True,
@@ -104,83 +122,106 @@ def main():
     batch_size=config["per_device_eval_batch_size"],
     collate_fn=default_data_collator
   )
-  total_steps = len(train_loader) * config["num_train_epochs"]
+  total_steps = math.ceil(len(train_loader) / config["grad_accumulation_steps"]) * config["num_train_epochs"]
   warmup_steps = int(total_steps * config["warmup_ratio"])
 
-  if config["layer_wise_flag"] == True:
-      optimizer_dict = {}
-      for p in model.parameters():
-          if p.requires_grad:
-              if config["optimizer"]== "MLorc_AdamW":
-                  optimizer_dict[p] = MLorc_AdamW([p], lr=config["learning_rate"], weight_decay=config["weight_decay"], rank=config["rank"])
-              elif config["optimizer"]== "MLorc_Lion":
-                  optimizer_dict[p] = MLorc_Lion([p], lr=config["learning_rate"], weight_decay=config["weight_decay"], rank=config["rank"])
-              elif config["optimizer"]== "Galore":
-                  optimizer_dict[p] = GaLore([p], lr=config["learning_rate"], weight_decay=config["weight_decay"], rank=config["rank"], T=config["GaLore_T"])
-              elif config["optimizer"]== "AdamW":
-                  optimizer_dict[p] = AdamW([p], lr=config["learning_rate"], weight_decay=config["weight_decay"])
-              elif config["optimizer"]== "Lion":
-                  optimizer_dict[p] = Lion([p], lr=config["learning_rate"], betas=(0.95, 0.98), weight_decay=config["weight_decay"])
-              else:
-                  raise RuntimeError("Incorrect optimizer config")
-      scheduler_dict = {}
-      for p in model.parameters():
-          if p.requires_grad:
-              scheduler_dict[p] = get_linear_schedule_with_warmup(optimizer_dict[p], num_warmup_steps=warmup_steps, num_training_steps=total_steps)
-
-      def optimizer_hook(p):
-          if p.grad is None:
-              return
-          optimizer_dict[p].step()
-          optimizer_dict[p].zero_grad()
-          scheduler_dict[p].step()
-      for p in model.parameters():
-          if p.requires_grad:
-              p.register_post_accumulate_grad_hook(optimizer_hook)
-
-  else:
-      if config["optimizer"]== "MLorc_AdamW":
-          optimizer = MLorc_AdamW(
-              model.parameters(),
-              lr=config["learning_rate"],
-              weight_decay=config["weight_decay"],
-              rank=config["rank"]
-              )
-      elif config["optimizer"]== "MLorc_Lion":
-          optimizer = MLorc_Lion(
-              model.parameters(),
-              lr=config["learning_rate"],
-              weight_decay=config["weight_decay"],
-              rank=config["rank"]
-              )
-      elif config["optimizer"]== "GaLore":
-          optimizer = GaLore(
-              model.parameters(),
-              lr=config["learning_rate"],
-              weight_decay=config["weight_decay"],
-              rank=config["rank"],
-              T=config["GaLore_T"]
-              )
-      elif config["optimizer"]== "AdamW":
-          optimizer = AdamW(
-              model.parameters(), 
-              lr=config["learning_rate"], 
-              weight_decay=config["weight_decay"]
-              )
-      elif config["optimizer"]== "Lion":
-          optimizer = Lion(
-              model.parameters(), 
-              lr=config["learning_rate"], 
-              betas=(0.95, 0.98),
-              weight_decay=config["weight_decay"]
-              )
-      else:
-          raise RuntimeError("Incorrect optimizer config")
-      scheduler = get_linear_schedule_with_warmup(
-          optimizer,
-          num_warmup_steps=warmup_steps,
-          num_training_steps=total_steps
+  if config["optimizer"]== "MLorc_AdamW":
+      optimizer = MLorc_AdamW(
+          model.parameters(),
+          lr=config["learning_rate"],
+          weight_decay=config["weight_decay"],
+          rank=config["rank"],
+          dense_fallback=config["dense_fallback"],
+          factor_update=config["factor_update"],
+          oversample=config["oversample"],
+          n_iter=config["n_iter"],
+          workers=config["optimizer_workers"],
+          intra_op_threads=config["intra_op_threads"],
+          sketch_seed=config["sketch_seed"],
+          sketch_refresh=config["sketch_refresh"]
+          )
+  elif config["optimizer"]== "MLorc_Lion":
+      optimizer = MLorc_Lion(
+          model.parameters(),
+          lr=config["learning_rate"],
+          weight_decay=config["weight_decay"],
+          rank=config["rank"],
+          dense_fallback=config["dense_fallback"],
+          oversample=config["oversample"],
+          n_iter=config["n_iter"],
+          workers=config["optimizer_workers"],
+          intra_op_threads=config["intra_op_threads"],
+          sketch_seed=config["sketch_seed"],
+          sketch_refresh=config["sketch_refresh"]
+          )
+  elif config["optimizer"]== "GaLore":
+      optimizer = GaLore(
+          model.parameters(),
+          lr=config["learning_rate"],
+          weight_decay=config["weight_decay"],
+          rank=config["rank"],
+          T=config["GaLore_T"],
+          dense_fallback=config["dense_fallback"],
+          refresh=config["GaLore_refresh"],
+          stagger=config["GaLore_stagger"],
+          workers=config["optimizer_workers"],
+          intra_op_threads=config["intra_op_threads"],
+          sketch_seed=config["sketch_seed"],
+          sketch_refresh=config["sketch_refresh"]
+          )
+  elif config["optimizer"]== "AdamW":
+      optimizer = AdamW(
+          model.parameters(), 
+          lr=config["learning_rate"], 
+          weight_decay=config["weight_decay"]
+          )
+  elif config["optimizer"]== "Lion":
+      optimizer = Lion(
+          model.parameters(), 
+          lr=config["learning_rate"], 
+          betas=(0.95, 0.98),
+          weight_decay=config["weight_decay"]
           )
+  else:
+      raise RuntimeError("Incorrect optimizer config")
+  scheduler = get_linear_schedule_with_warmup(
+      optimizer,
+      num_warmup_steps=warmup_steps,
+      num_training_steps=total_steps
+      )
+
+  if config["layer_wise_flag"] == True:
+      # one optimizer and one schedule; each parameter is updated from its own backward hook
+      layerwise = LayerwiseOptimizer(optimizer, scheduler)
+
+  accumulator = None
+  if config["grad_accumulation_steps"] > 1:
+      if config["layer_wise_flag"]:
+          raise RuntimeError("layer_wise_flag steps on every backward pass and cannot accumulate gradients")
+      # matrix gradients are sketched and freed in backward hooks; the accumulator steps optimizer and scheduler
+      accumulator = LowRankGradAccumulator(optimizer, config["grad_accumulation_steps"], rank=config["grad_accumulation_rank"],
+                                           oversample=config["grad_accumulation_oversample"], scheduler=scheduler)
+
+  if config["resume_optimizer_state"] is not None:
+      metadata = load_optimizer_state(optimizer, model.named_parameters(), config["resume_optimizer_state"])
+      scheduler.load_state_dict(metadata["scheduler"])
+
+  if local_rank == 0 and hasattr(optimizer, "memory_report"):
+      # predicted from the shapes before the first step, to plan rank and batch size per node
+      memory = optimizer.memory_report(model.named_parameters())
+      with TitledLog("optimizer memory", log_fn=log.info):
+          log.info(f'state: {memory["state"] / 2**30:.3f} GiB, dense AdamW: {memory["dense_adamw"] / 2**30:.3f} GiB '
+                   f'({memory["state"] / max(1, memory["dense_adamw"]):.2%})')
+          log.info(f'SVD workspace: {memory["workspace"] / 2**30:.3f} GiB, '
+                   f'step temporaries: {memory["temporaries"] / 2**30:.3f} GiB')
+          for i, group_bytes in enumerate(memory["groups"]):
+              log.info(f'param group {i}: {group_bytes / 2**30:.3f} GiB')
+          if accumulator is not None:
+              log.info(f'gradient accumulation sketches: {accumulator.sketch_bytes() / 2**30:.3f} GiB')
+
+  profiler = None
+  if config["profile_optimizer_steps"] > 0:
+      profiler = StepProfiler(optimizer, model.named_parameters()).attach()
 
   # 训练循环
   model.train()
@@ -201,7 +242,7 @@ def main():
           # 反向传播
           loss.backward()
           # 参数更新
-          if not config["layer_wise_flag"]:
+          if not config["layer_wise_flag"] and accumulator is None:
               optimizer.step()
               optimizer.zero_grad()
               scheduler.step()
@@ -221,6 +262,19 @@ def main():
 
           global_step += 1
 
+          # global_step counts micro-batches; the profiler counts optimizer steps, however they are taken
+          if profiler is not None and profiler.steps >= config["profile_optimizer_steps"]:
+              profiler.detach()
+              if local_rank == 0:
+                  profiler.log(log.info)
+                  trace_dir = f'./logs/transformers/llama-2-7b/code/optimizer_{config["optimizer"]}/lr_{config["learning_rate"]}'
+                  os.makedirs(trace_dir, exist_ok=True)
+                  profiler.export_chrome_trace(os.path.join(trace_dir, "optimizer_trace.json"))
+              profiler = None
+
+      if accumulator is not None:
+          accumulator.flush()
+
       # 评估阶段（每个 epoch 结束后）
       model.eval()
       eval_loss = 0
@@ -244,6 +298,9 @@ def main():
   if local_rank == 0:
       model.save_pretrained(f'./logs/transformers/llama-2-7b/code/optimizer_{config["optimizer"]}/lr_{config["learning_rate"]}')
       tokenizer.save_pretrained(f'./logs/transformers/llama-2-7b/code/optimizer_{config["optimizer"]}/lr_{config["learning_rate"]}')
+      if config["save_optimizer_state"]:
+          save_optimizer_state(optimizer, model.named_parameters(), f'./logs/transformers/llama-2-7b/code/optimizer_{config["optimizer"]}/lr_{config["learning_rate"]}/optimizer_state',
+                               metadata={"global_step": global_step, "scheduler": scheduler.state_dict()})
 
       wandb.finish()
 